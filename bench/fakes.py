@@ -0,0 +1,359 @@
+import email.parser
+import email.policy
+import http.server
+import json
+import random
+import socket
+import threading
+import time
+import urllib.parse
+
+# Coins every fake knows. The rest are made up to fill the coin list
+known_coins = ['bitcoin', 'ethereum', 'tether', 'solana', 'cardano',
+               'dogecoin', 'polkadot', 'litecoin', 'chainlink', 'stellar',
+               'monero', 'uniswap', 'bitcoin-cash', 'avalanche-2', 'tron']
+
+currencies = ['usd', 'eur', 'gbp', 'cad', 'chf', 'aud', 'inr']
+
+# Languages of the descriptions of the coins
+languages = ['en', 'de', 'es', 'fr', 'it', 'pl', 'ro', 'hu', 'nl', 'pt', 'sv',
+             'vi', 'tr', 'ru', 'ja', 'zh', 'zh-tw', 'ko', 'ar', 'th', 'id',
+             'cs', 'da', 'el', 'hi', 'no', 'sk', 'uk', 'he', 'fi', 'bg', 'hr',
+             'lt', 'sl']
+
+
+class FakeServer:
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        # Every answer waits latency seconds (+-50%) and error_rate of them
+        # fail. Subclasses answer the requests in answer()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}  # Endpoint -> requests received
+        self.errors = 0
+
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'  # Keep connections alive
+
+            def setup(self):
+                # Headers and body are written apart, don't delay the body
+                super().setup()
+                self.connection.setsockopt(socket.IPPROTO_TCP,
+                                           socket.TCP_NODELAY, 1)
+
+            def do_GET(self):
+                self.reply(None)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                self.reply(self.rfile.read(length))
+
+            def reply(self, body):
+                url = urllib.parse.urlsplit(self.path)
+                params = dict(urllib.parse.parse_qsl(url.query))
+                params.update(_form(self.headers, body))
+                status, answer, headers = fake.handle(url.path, params)
+                data = json.dumps(answer).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                     Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def handle(self, path, params):
+        endpoint = self.endpoint(path)
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            delay = self.latency * self.random.uniform(0.5, 1.5)
+            failed = self.random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        if delay > 0:
+            time.sleep(delay)
+        if failed and self.can_fail(endpoint):
+            return self.error()
+        return self.answer(endpoint, path, params)
+
+    def endpoint(self, path):
+        raise NotImplementedError
+
+    def can_fail(self, endpoint):
+        return True
+
+    def error(self):
+        return 500, {'error': 'Internal error'}, {}
+
+    def answer(self, endpoint, path, params):
+        raise NotImplementedError
+
+    def url(self):
+        return 'http://127.0.0.1:' + str(self.httpd.server_address[1]) + '/'
+
+    def reset(self):
+        with self.lock:
+            self.calls = {}
+            self.errors = 0
+
+    def stats(self):
+        with self.lock:
+            return {'calls': dict(self.calls), 'errors': self.errors}
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FakeCoinGecko(FakeServer):
+
+    def __init__(self, latency=0.0, error_rate=0.0, coins=1000,
+                 payload_scale=1.0, seed=0):
+        # payload_scale multiplies the points of the market charts
+        super().__init__(latency, error_rate, seed)
+        self.payload_scale = payload_scale
+        self.coins = known_coins + ['coin-' + str(number) for number
+                                    in range(max(coins - len(known_coins),
+                                                 0))]
+        self.coin_set = set(self.coins)
+
+    def url(self):
+        return super().url() + 'api/v3/'
+
+    def endpoint(self, path):
+        parts = path.split('/')[3:]  # After /api/v3/
+        if parts[:1] == ['coins'] and len(parts) == 2 and \
+                parts[1] not in ('list', 'markets'):
+            return 'coins/{id}'
+        if parts[:1] == ['coins'] and len(parts) == 3:
+            return 'coins/{id}/' + parts[2]
+        return '/'.join(parts)
+
+    def answer(self, endpoint, path, params):
+        coin = path.split('/')[4] if endpoint.startswith('coins/{id}') \
+            else None
+        if coin is not None and coin not in self.coin_set:
+            return 404, {'error': 'coin not found'}, {}
+
+        if endpoint == 'simple/price':
+            prices = {}
+            for coin in params.get('ids', '').split(','):
+                if coin in self.coin_set:
+                    prices[coin] = {currency: _price(coin, currency)
+                                    for currency in
+                                    params['vs_currencies'].split(',')}
+            return 200, prices, {}
+
+        if endpoint == 'coins/{id}/market_chart':
+            return 200, {'prices': self._chart(coin, params)}, {}
+
+        if endpoint == 'coins/{id}':
+            return 200, self._coin(
+                coin, 'market_data' not in params,
+                params.get('localization', 'true').lower() != 'false'
+            ), {}
+
+        if endpoint == 'coins/markets':
+            limit = int(params.get('per_page', 100))
+            return 200, [self._market(coin, params['vs_currency'])
+                         for coin in self.coins[:limit]], {}
+
+        if endpoint == 'coins/list':
+            return 200, [{'id': coin, 'symbol': coin[:4],
+                          'name': coin.replace('-', ' ').title()}
+                         for coin in self.coins], {}
+
+        return 404, {'error': 'Unknown endpoint'}, {}
+
+    def _chart(self, coin, params):
+        days = params.get('days', '1')
+        days = 5000 if days == 'max' else float(days)
+        if days <= 1:
+            step = 5 * 60 * 1000
+        elif days <= 90:
+            step = 60 * 60 * 1000
+        else:
+            step = 24 * 60 * 60 * 1000
+        points = max(int(days * 24 * 60 * 60 * 1000 / step *
+                         self.payload_scale), 2)
+        now = int(time.time() * 1000)
+        start = now - int(days * 24 * 60 * 60 * 1000)
+        interval = (now - start) // (points - 1)
+        base = _price(coin, params.get('vs_currency', 'usd'))
+        return [[start + number * interval,
+                 base * (1 + 0.1 * ((number * 7919) % 101 - 50) / 50)]
+                for number in range(points)]
+
+    def _coin(self, coin, with_market_data, with_localization):
+        # Like CoinGecko, the description always comes in every language
+        name = coin.replace('-', ' ').title()
+        text = (name + ' is a cryptocurrency. ') * 100
+        answer = {'id': coin,
+                  'symbol': coin[:4],
+                  'name': name,
+                  'genesis_date': '2009-01-03',
+                  'coingecko_rank': self.coins.index(coin) + 1,
+                  'block_time_in_minutes': 10,
+                  'links': {'homepage': ['https://example.com'],
+                            'twitter_screen_name': coin,
+                            'facebook_username': '',
+                            'telegram_channel_identifier': '',
+                            'subreddit_url': ''},
+                  'description': {language: text for language in languages}}
+        if with_localization:
+            answer['localization'] = {language: name
+                                      for language in languages}
+        if with_market_data:
+            changes = {}
+            for interval in ('1h', '24h', '7d', '14d', '30d', '60d',
+                             '200d', '1y'):
+                changes['price_change_percentage_' + interval +
+                        '_in_currency'] = {currency: 1.5
+                                           for currency in currencies}
+            answer['market_data'] = dict(
+                changes,
+                market_cap={currency: _price(coin, currency) * 1e7
+                            for currency in currencies},
+                circulating_supply=1.9e7,
+                total_supply=2.1e7
+            )
+        return answer
+
+    def _market(self, coin, currency):
+        return {'id': coin,
+                'name': coin.replace('-', ' ').title(),
+                'current_price': _price(coin, currency),
+                'price_change_percentage_24h':
+                    (sum(map(ord, coin)) * 13 % 2000 - 1000) / 100}
+
+
+class FakeTelegram(FakeServer):
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        # Updates are added with push(). Every message sent is matched with
+        # the oldest update of its chat still without reply
+        super().__init__(latency, error_rate, seed)
+        self.condition = threading.Condition(self.lock)
+        self.updates = []  # Not confirmed yet
+        self.next_update = 1
+        self.waiting = {}  # Chat -> push times of the updates not answered
+        self.latencies = []  # Seconds between push and reply
+        self.replies = 0
+        self.photos = 0
+
+    def endpoint(self, path):
+        return path.rsplit('/', 1)[-1]
+
+    def can_fail(self, endpoint):
+        return endpoint in ('sendMessage', 'sendPhoto')
+
+    def error(self):
+        # Telegram answers too many messages with 429
+        return 429, {'ok': False, 'error_code': 429,
+                     'parameters': {'retry_after': 1}}, {}
+
+    def push(self, chat_id, text):
+        with self.condition:
+            self.updates.append({
+                'update_id': self.next_update,
+                'message': {'message_id': self.next_update,
+                            'date': int(time.time()),
+                            'chat': {'id': chat_id, 'type': 'private',
+                                     'first_name': 'Bench'},
+                            'text': text}
+            })
+            self.next_update += 1
+            self.waiting.setdefault(chat_id, []).append(time.monotonic())
+            self.condition.notify_all()
+
+    def answer(self, endpoint, path, params):
+        if endpoint == 'getUpdates':
+            return 200, {'ok': True, 'result': self._get_updates(params)}, {}
+
+        if endpoint in ('sendMessage', 'sendPhoto'):
+            chat_id = int(params['chat_id'])
+            with self.condition:
+                self.replies += 1
+                pending = self.waiting.get(chat_id)
+                if pending:
+                    self.latencies.append(time.monotonic() - pending.pop(0))
+                if endpoint == 'sendPhoto':
+                    self.photos += 1
+                    result = {'photo': [{'file_id': 'photo-' +
+                                         str(self.photos)}]}
+                else:
+                    result = {'message_id': self.replies}
+                self.condition.notify_all()
+            return 200, {'ok': True, 'result': result}, {}
+
+        return 200, {'ok': True, 'result': True}, {}
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit', 100))
+        deadline = time.monotonic() + float(params.get('timeout', 0))
+        with self.condition:
+            self.updates = [update for update in self.updates
+                            if update['update_id'] >= offset]
+            while len(self.updates) == 0 and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+            return self.updates[:limit]
+
+    def wait_replies(self, count, timeout):
+        # Wait until count replies were sent. Returns False on timeout
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while len(self.latencies) < count:
+                if time.monotonic() >= deadline:
+                    return False
+                self.condition.wait(deadline - time.monotonic())
+            return True
+
+    def reset(self):
+        super().reset()
+        with self.condition:
+            self.waiting = {}
+            self.latencies = []
+            self.replies = 0
+
+
+def _price(coin, currency):
+    # Stable made up price of every coin
+    return (sum(map(ord, coin)) * 37 % 5000 + 1) * \
+        (1 + currencies.index(currency) / 10 if currency in currencies
+         else 1)
+
+
+def _form(headers, body):
+    # Parameters in the body of a POST, URL encoded or multipart
+    if not body:
+        return {}
+    content_type = headers.get('Content-Type', '')
+    if content_type.startswith('application/x-www-form-urlencoded'):
+        return dict(urllib.parse.parse_qsl(body.decode()))
+    if content_type.startswith('multipart/form-data'):
+        message = email.parser.BytesParser(
+            policy=email.policy.default
+        ).parsebytes(
+            b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body
+        )
+        params = {}
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if part.get_filename() is None:
+                params[name] = part.get_payload(decode=True).decode()
+        return params
+    return {}
@@ -0,0 +1,229 @@
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+# The bot modules import each other by name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'bot'))
+
+import fakes  # noqa: E402
+import charts  # noqa: E402
+import coin_index  # noqa: E402
+import coingecko_api  # noqa: E402
+import commands  # noqa: E402
+import dispatcher  # noqa: E402
+import poller  # noqa: E402
+import price_store  # noqa: E402
+import rate_limit  # noqa: E402
+import render_pool  # noqa: E402
+import router  # noqa: E402
+import send_queue  # noqa: E402
+import telegram_api  # noqa: E402
+
+# Commands sent by every workload and how often (relative weights)
+workloads = {'price': [(1, '!price {coin}')],
+             'evolution': [(1, '!evolution_img {days} {currency} {coin}')],
+             'top': [(1, '!top_coins {currency}')],
+             'market': [(1, '!market_cap {coin}'), (1, '!supply {coin}'),
+                        (1, '!info {coin}'),
+                        (1, '!price_change {interval} {coin}')],
+             'mixed': [(7, '!price {coin}'),
+                       (2, '!evolution_img {days} {currency} {coin}'),
+                       (1, '!top_coins {currency}')]}
+
+
+def script(workload, updates, chats, coins, seed):
+    # (chat, text) of every update, always the same for the same seed
+    generator = random.Random(seed)
+    weights, templates = zip(*workloads[workload])
+    messages = []
+    for number in range(updates):
+        template = generator.choices(templates, weights)[0]
+        messages.append((number % chats + 1, template.format(
+            coin=generator.choice(coins),
+            days=generator.choice(['1', '7', '30', '365']),
+            currency=generator.choice(['usd', 'eur']),
+            interval=generator.choice(['1h', '24h', '7d', '30d'])
+        )))
+    return messages
+
+
+def run(workload, telegram, coinGecko, options):
+    # Fresh bot (empty caches) against the fake servers
+    directory = tempfile.mkdtemp(prefix='bench-')
+    bot = telegram_api.TelegramRequester('bench', url=telegram.url() +
+                                         'bot{}/')
+    upstream = coingecko_api.CoinGeckoRequester(
+        url=coinGecko.url(),
+        store=price_store.PriceStore(os.path.join(directory, 'prices')),
+        scheduler=rate_limit.Scheduler(
+            rate_per_minute=options.upstream_rate, burst=20
+        )
+    )
+    coins = coin_index.CoinIndex(os.path.join(directory, 'coins.json'))
+    coin_index.Refresher(coins, upstream).refresh()
+
+    renderer = render_pool.RenderPool(processes=options.processes)
+    sender = send_queue.SendQueue(bot, global_rate=options.send_rate,
+                                  global_burst=options.send_rate,
+                                  chat_rate=options.chat_rate)
+    commandRouter = router.Router(commands.Context(
+        sender, upstream, renderer,
+        charts.ImageCache(max_bytes=32 * 1024 * 1024), coins
+    ))
+    updates = dispatcher.Dispatcher(commandRouter.handle, max_workers=8,
+                                    max_pending=64)
+    updatePoller = poller.Poller(bot, updates, timeout=1)
+    updatePoller.start()
+
+    messages = script(workload, options.updates, options.chats,
+                      fakes.known_coins, options.seed)
+    telegram.reset()
+    coinGecko.reset()
+
+    start = time.monotonic()
+    for chat_id, text in messages:
+        telegram.push(chat_id, text)
+        if options.rate > 0:
+            time.sleep(1 / options.rate)
+    finished = telegram.wait_replies(len(messages), options.timeout)
+    elapsed = time.monotonic() - start
+
+    updatePoller.stop()
+    updatePoller.join()
+    sender.close()
+    updates.shutdown()
+    renderer.close()
+
+    latencies = sorted(telegram.latencies)
+    calls = coinGecko.stats()['calls']
+    return {'workload': workload,
+            'finished': finished,
+            'updates': len(messages),
+            'replies': len(latencies),
+            'updates_per_second': round(len(latencies) / elapsed, 1),
+            'p50_ms': _percentile(latencies, 0.50),
+            'p99_ms': _percentile(latencies, 0.99),
+            'upstream_calls': sum(calls.values()),
+            'upstream_per_command': round(sum(calls.values()) /
+                                          len(messages), 3),
+            'upstream_by_endpoint': calls,
+            'peak_rss_mb': _peak_rss()}
+
+
+def _percentile(latencies, fraction):
+    if len(latencies) == 0:
+        return None
+    index = min(int(len(latencies) * fraction), len(latencies) - 1)
+    return round(latencies[index] * 1000, 1)
+
+
+def _peak_rss():
+    # Highest resident memory of this process and of the render workers
+    # (ru_maxrss is in kilobytes on Linux)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + \
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(peak / 1024, 1)
+
+
+def compare(results, baseline, tolerance):
+    # Regressions against a previous run: less throughput or slower replies
+    # than the tolerance allows
+    regressions = []
+    previous = {result['workload']: result for result in baseline}
+    for result in results:
+        old = previous.get(result['workload'])
+        if old is None:
+            continue
+        if result['updates_per_second'] < \
+                old['updates_per_second'] * (1 - tolerance):
+            regressions.append(result['workload'] + ': updates/s ' +
+                               str(old['updates_per_second']) + ' -> ' +
+                               str(result['updates_per_second']))
+        if old['p99_ms'] is not None and result['p99_ms'] is not None and \
+                result['p99_ms'] > old['p99_ms'] * (1 + tolerance):
+            regressions.append(result['workload'] + ': p99 ' +
+                               str(old['p99_ms']) + ' ms -> ' +
+                               str(result['p99_ms']) + ' ms')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the bot against local fake servers'
+    )
+    parser.add_argument('workloads', nargs='*', default=list(workloads),
+                        help=', '.join(workloads) + ' (all by default)')
+    parser.add_argument('--updates', type=int, default=300)
+    parser.add_argument('--chats', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=0,
+                        help='updates pushed per second (0: all at once)')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--coingecko-latency', type=float, default=0.05)
+    parser.add_argument('--coingecko-errors', type=float, default=0.0)
+    parser.add_argument('--telegram-latency', type=float, default=0.02)
+    parser.add_argument('--telegram-errors', type=float, default=0.0)
+    parser.add_argument('--coins', type=int, default=1000,
+                        help='size of the coin list')
+    parser.add_argument('--payload-scale', type=float, default=1.0,
+                        help='multiplies the points of the market charts')
+    parser.add_argument('--upstream-rate', type=float, default=6000,
+                        help='CoinGecko calls per minute allowed')
+    parser.add_argument('--send-rate', type=float, default=1000,
+                        help='Telegram messages per second allowed')
+    parser.add_argument('--chat-rate', type=float, default=100,
+                        help='Telegram messages per second in a chat')
+    parser.add_argument('--processes', type=int, default=2,
+                        help='chart rendering processes (0: inline)')
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--baseline', help='JSON of a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    options = parser.parse_args()
+    for workload in options.workloads:
+        if workload not in workloads:
+            parser.error('unknown workload ' + workload)
+
+    telegram = fakes.FakeTelegram(options.telegram_latency,
+                                  options.telegram_errors, options.seed)
+    coinGecko = fakes.FakeCoinGecko(options.coingecko_latency,
+                                    options.coingecko_errors, options.coins,
+                                    options.payload_scale, options.seed)
+
+    results = []
+    for workload in options.workloads:
+        result = run(workload, telegram, coinGecko, options)
+        results.append(result)
+        print(workload.ljust(10),
+              str(result['updates_per_second']).rjust(8), 'updates/s',
+              str(result['p50_ms']).rjust(8), 'ms p50',
+              str(result['p99_ms']).rjust(8), 'ms p99',
+              str(result['upstream_per_command']).rjust(6), 'calls/cmd',
+              str(result['peak_rss_mb']).rjust(7), 'MB peak',
+              '' if result['finished'] else '(TIMED OUT)')
+
+    telegram.close()
+    coinGecko.close()
+
+    if options.output is not None:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+    failed = not all(result['finished'] for result in results)
+    if options.baseline is not None:
+        with open(options.baseline) as baseline:
+            regressions = compare(results, json.load(baseline),
+                                  options.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        failed = failed or len(regressions) > 0
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+import bisect
+import logging
+import sqlite3
+import threading
+import time
+
+
+class Alert:
+
+    __slots__ = ('id', 'chat_id', 'coin', 'currency', 'above', 'threshold')
+
+    def __init__(self, id, chat_id, coin, currency, above, threshold):
+        self.id = id
+        self.chat_id = chat_id
+        self.coin = coin
+        self.currency = currency
+        self.above = above  # Fires when the price goes above the threshold
+        self.threshold = threshold
+
+
+class Thresholds:
+
+    def __init__(self):
+        # Alerts of a coin and currency sorted by threshold, in a list of
+        # thresholds (for bisect) and a list of alerts in the same order
+        self.thresholds = []
+        self.alerts = []
+
+    def add(self, alert):
+        index = bisect.bisect_right(self.thresholds, alert.threshold)
+        self.thresholds.insert(index, alert.threshold)
+        self.alerts.insert(index, alert)
+
+    def remove(self, alert):
+        index = bisect.bisect_left(self.thresholds, alert.threshold)
+        while self.alerts[index] is not alert:
+            index += 1
+        del self.thresholds[index]
+        del self.alerts[index]
+
+    def pop_below(self, price):
+        # Alerts with threshold <= price
+        index = bisect.bisect_right(self.thresholds, price)
+        fired = self.alerts[:index]
+        del self.thresholds[:index]
+        del self.alerts[:index]
+        return fired
+
+    def pop_above(self, price):
+        # Alerts with threshold >= price
+        index = bisect.bisect_left(self.thresholds, price)
+        fired = self.alerts[index:]
+        del self.thresholds[index:]
+        del self.alerts[index:]
+        return fired
+
+    def __len__(self):
+        return len(self.alerts)
+
+
+class AlertStore:
+
+    def __init__(self, path='alerts.db', max_per_chat=20):
+        # Alerts are kept in SQLite, and in memory indexed by coin and
+        # currency. Every alert fires only once
+        self.max_per_chat = max_per_chat
+        self.lock = threading.Lock()
+        self.database = sqlite3.connect(path, check_same_thread=False)
+        self.database.execute(
+            'CREATE TABLE IF NOT EXISTS alerts ('
+            'id INTEGER PRIMARY KEY, chat_id INTEGER, coin TEXT, '
+            'currency TEXT, above INTEGER, threshold REAL, created REAL)'
+        )
+        self.database.commit()
+
+        # (coin, currency) -> [Thresholds of the alerts going above,
+        # Thresholds of the alerts going below]
+        self.index = {}
+        self.chats = {}  # Chat -> {alert id -> alert}
+        for row in self.database.execute(
+                'SELECT id, chat_id, coin, currency, above, threshold '
+                'FROM alerts'):
+            self._index(Alert(row[0], row[1], row[2], row[3], bool(row[4]),
+                              row[5]))
+
+    def _index(self, alert):
+        key = (alert.coin, alert.currency)
+        if key not in self.index:
+            self.index[key] = [Thresholds(), Thresholds()]
+        self.index[key][0 if alert.above else 1].add(alert)
+        self.chats.setdefault(alert.chat_id, {})[alert.id] = alert
+
+    def _unindex(self, alert):
+        key = (alert.coin, alert.currency)
+        self.index[key][0 if alert.above else 1].remove(alert)
+        if len(self.index[key][0]) + len(self.index[key][1]) == 0:
+            del self.index[key]
+        self._forget(alert)
+
+    def _forget(self, alert):
+        alerts = self.chats[alert.chat_id]
+        del alerts[alert.id]
+        if len(alerts) == 0:
+            del self.chats[alert.chat_id]
+
+    def add(self, chat_id, coin, currency, above, threshold):
+        # Returns the new alert, or None if the chat has too many
+        with self.lock:
+            if len(self.chats.get(chat_id, {})) >= self.max_per_chat:
+                return None
+            cursor = self.database.execute(
+                'INSERT INTO alerts (chat_id, coin, currency, above, '
+                'threshold, created) VALUES (?, ?, ?, ?, ?, ?)',
+                (chat_id, coin, currency, int(above), threshold, time.time())
+            )
+            self.database.commit()
+            alert = Alert(cursor.lastrowid, chat_id, coin, currency, above,
+                          threshold)
+            self._index(alert)
+            return alert
+
+    def remove(self, chat_id, alert_id):
+        # Returns False if the chat has no alert with that id
+        with self.lock:
+            alert = self.chats.get(chat_id, {}).get(alert_id)
+            if alert is None:
+                return False
+            self.database.execute('DELETE FROM alerts WHERE id = ?',
+                                  (alert_id,))
+            self.database.commit()
+            self._unindex(alert)
+            return True
+
+    def of_chat(self, chat_id):
+        with self.lock:
+            return sorted(self.chats.get(chat_id, {}).values(),
+                          key=lambda alert: alert.id)
+
+    def coins(self):
+        # Coins with any alert
+        with self.lock:
+            return sorted({coin for coin, _ in self.index})
+
+    def fire(self, prices):
+        # Remove and return the alerts whose condition holds for prices
+        # (coin -> currency -> price). Only the alerts that fire are touched
+        fired = []
+        with self.lock:
+            for key in list(self.index):
+                price = prices.get(key[0], {}).get(key[1])
+                if price is None:
+                    continue
+                above, below = self.index[key]
+                fired.extend(above.pop_below(price))
+                fired.extend(below.pop_above(price))
+                if len(above) + len(below) == 0:
+                    del self.index[key]
+
+            for alert in fired:
+                self._forget(alert)
+            if len(fired) > 0:
+                self.database.executemany('DELETE FROM alerts WHERE id = ?',
+                                          [(alert.id,) for alert in fired])
+                self.database.commit()
+        return fired
+
+    def stats(self):
+        with self.lock:
+            return {'alerts': sum(len(alerts)
+                                  for alerts in self.chats.values()),
+                    'chats': len(self.chats),
+                    'series': len(self.index)}
+
+
+class AlertEngine(threading.Thread):
+
+    def __init__(self, store, coinGecko, notify, interval=60, chunk=100):
+        # Every interval seconds, gets the prices of every coin with alerts
+        # in batches of chunk coins and calls notify(alert, price) for every
+        # alert fired
+        super().__init__(name='alerts', daemon=True)
+        self.store = store
+        self.coinGecko = coinGecko
+        self.notify = notify
+        self.interval = interval
+        self.chunk = chunk
+        self.ticks = 0
+        self.fired = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.tick()
+            except Exception:
+                logging.warning('Alerts failed to get prices')
+
+    def stop(self):
+        self.stopped.set()
+
+    def tick(self):
+        coins = self.store.coins()
+        prices = {}
+        with self.coinGecko.background():
+            for start in range(0, len(coins), self.chunk):
+                prices.update(self.coinGecko.simple_prices(
+                    coins[start:start + self.chunk]
+                ))
+
+        fired = self.store.fire(prices)
+        for alert in fired:
+            try:
+                self.notify(alert, prices[alert.coin][alert.currency])
+            except Exception:
+                logging.exception('Alert ' + str(alert.id) + ' failed')
+        self.ticks += 1
+        self.fired += len(fired)
+        return fired
@@ -0,0 +1,140 @@
+import collections
+import datetime
+import io
+import threading
+import time
+import series
+
+# Every chart gets its own figure drawn by the non-interactive Agg backend,
+# instead of the global pyplot figure. That way, several charts can be
+# rendered at the same time from different threads. matplotlib takes a while
+# to import, so it's only loaded when the first chart is drawn or by warm()
+
+
+def evolution_chart(timestamps, prices, title, ylabel, points=500):
+    # The image can't show more detail than a few hundred points, so long
+    # series are resampled before converting their times to dates
+    timestamps, prices = series.resample(timestamps, prices, points)
+    x = [datetime.datetime.fromtimestamp(t) for t in timestamps // 1000]
+    return line_chart(x, prices, title, ylabel)
+
+
+def line_chart(x, y, title, ylabel):
+    figure, axes = _new_figure()
+    axes.plot(x, y)
+    axes.set_title(title)
+    axes.set_ylabel(ylabel)
+    axes.tick_params(axis='x', labelrotation=90)  # Fit values in x-axis
+    return _to_png(figure)
+
+
+def bar_chart(x, y, colors, title, ylabel):
+    figure, axes = _new_figure()
+    axes.bar(x, y, color=colors)
+    axes.set_title(title)
+    axes.set_ylabel(ylabel)
+    axes.tick_params(axis='x', labelrotation=90)  # Fit long names in x-axis
+    return _to_png(figure)
+
+
+def warm():
+    # Load the chart stack (matplotlib, fonts) by drawing a small chart, so
+    # the first chart asked doesn't wait for it. Returns the seconds it took
+    start = time.monotonic()
+    bar_chart(['warm'], [1], ['g'], 'Warm', '%')
+    return time.monotonic() - start
+
+
+def _new_figure():
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    return figure, figure.add_subplot()
+
+
+def _to_png(figure):
+    # PNG image as bytes, rendered in memory instead of a file on disk
+    figure.tight_layout()  # Give enough room to the graph
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format='png')
+    return buffer.getvalue()
+
+
+class ImageCache:
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0  # Bytes of all the images cached
+        self.entries = collections.OrderedDict()  # Key -> [png, file_id]
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        # Returns a (png, file_id) tuple, or None if the chart isn't cached.
+        # The file_id is None until Telegram returns it
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)  # Most recently used goes last
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, key, png):
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries[key][0])
+            self.entries[key] = [png, None]
+            self.entries.move_to_end(key)
+            self.size += len(png)
+
+            # Evict the least recently used images until everything fits
+            while self.size > self.max_bytes and len(self.entries) > 0:
+                evicted = self.entries.popitem(last=False)[1]
+                self.size -= len(evicted[0])
+
+    def set_file_id(self, key, file_id):
+        with self.lock:
+            if key in self.entries:
+                self.entries[key][1] = file_id
+
+    def dump(self):
+        # (key, png, file_id) of every image, least recently used first
+        with self.lock:
+            return [(key, png, file_id)
+                    for key, (png, file_id) in self.entries.items()]
+
+    def restore(self, entries):
+        for key, png, file_id in entries:
+            self.put(key, png)
+            self.set_file_id(key, file_id)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'size': len(self.entries),
+                    'bytes': self.size}
+
+
+def evolution_key(coin, currency, days):
+    # Charts of a few hours change faster, so they expire sooner
+    try:
+        short = float(days) <= 1
+    except ValueError:
+        short = False  # "max"
+    return _bucket_key(('evolution', coin, currency, days),
+                       5 * 60 if short else 60 * 60)
+
+
+def top_coins_key(currency):
+    return _bucket_key(('top_coins', currency), 5 * 60)
+
+
+def _bucket_key(key, seconds):
+    # Same key during the whole time bucket, so charts requested in the
+    # same bucket are reused and the next bucket draws a new one
+    return key + (int(time.time() // seconds),)
@@ -0,0 +1,185 @@
+import bisect
+import collections
+import difflib
+import json
+import logging
+import os
+import threading
+import time
+
+
+class CoinIndex:
+
+    def __init__(self, path='coins.json'):
+        # Every coin CoinGecko knows, to find the id of a coin given its id,
+        # symbol or name without asking upstream. Kept in path between runs
+        self.path = path
+        self.lock = threading.Lock()
+        self.updated = None  # Wall clock time of the coin list
+        self._build([], [])
+        self.load()
+
+    def _build(self, coins, ranking):
+        # coins: [id, symbol, name] lists. ranking: ids by market cap. The
+        # lookups are replaced all at once, readers never see half of them
+        ids = set()
+        keys = collections.defaultdict(list)  # Id, symbol or name -> ids
+        for coin_id, symbol, name in coins:
+            ids.add(coin_id)
+            for key in (coin_id, symbol.lower(), name.lower()):
+                if coin_id not in keys[key]:
+                    keys[key].append(coin_id)
+
+        # Coins sharing a symbol or a name: the biggest one goes first
+        rank = {coin_id: position for position, coin_id in enumerate(ranking)}
+        for key in keys:
+            keys[key].sort(key=lambda coin_id: (rank.get(coin_id, len(rank)),
+                                                len(coin_id)))
+
+        # Fuzzy matching only compares keys starting with the same character
+        initials = collections.defaultdict(list)
+        for key in keys:
+            initials[key[:1]].append(key)
+
+        with self.lock:
+            self.coins = coins
+            self.ranking = ranking
+            self.rank = rank
+            self.ids = ids
+            self.keys = dict(keys)
+            self.sorted_keys = sorted(keys)  # For prefix matching
+            self.initials = dict(initials)
+
+    def ready(self):
+        with self.lock:
+            return len(self.ids) > 0
+
+    def resolve(self, name):
+        # CoinGecko id of the coin, None if there isn't any
+        name = ' '.join(name.lower().split())
+        with self.lock:
+            hyphenated = name.replace(' ', '-')
+            if hyphenated in self.ids:
+                return hyphenated
+            matches = self.keys.get(name)
+            if matches is not None:
+                return matches[0]
+        return None
+
+    def suggest(self, name, limit=3):
+        # Ids of the coins whose id, symbol or name starts like name or
+        # looks like it
+        name = ' '.join(name.lower().split())
+        suggestions = []
+        with self.lock:
+            start = bisect.bisect_left(self.sorted_keys, name)
+            for key in self.sorted_keys[start:start + 50]:
+                if not key.startswith(name):
+                    break
+                suggestions.extend(self.keys[key])
+            suggestions.sort(key=lambda coin_id: (
+                self.rank.get(coin_id, len(self.rank)), len(coin_id)
+            ))
+
+            if len(suggestions) < limit:
+                close = difflib.get_close_matches(
+                    name, self.initials.get(name[:1], []), limit, 0.75
+                )
+                for key in close:
+                    suggestions.extend(self.keys[key])
+
+        unique = []
+        for coin_id in suggestions:
+            if coin_id not in unique:
+                unique.append(coin_id)
+        return unique[:limit]
+
+    def update(self, coins, ranking):
+        self._build([[coin['id'], coin['symbol'], coin['name']]
+                     for coin in coins], ranking)
+        self.updated = time.time()
+        self.save()
+
+    def load(self):
+        # Returns False if there's nothing stored
+        try:
+            with open(self.path) as stored:
+                data = json.load(stored)
+        except (OSError, ValueError):
+            return False
+        self._build(data['coins'], data['ranking'])
+        self.updated = data['updated']
+        return True
+
+    def save(self):
+        with self.lock:
+            data = {'updated': self.updated,
+                    'coins': self.coins,
+                    'ranking': self.ranking}
+        with open(self.path + '.tmp', 'w') as stored:
+            json.dump(data, stored)
+        os.replace(self.path + '.tmp', self.path)
+
+    def age(self):
+        # Seconds since the coin list was downloaded (by any process)
+        try:
+            return time.time() - os.path.getmtime(self.path)
+        except OSError:
+            return None
+
+    def stats(self):
+        with self.lock:
+            return {'coins': len(self.ids), 'keys': len(self.keys)}
+
+
+class Refresher(threading.Thread):
+
+    def __init__(self, index, coinGecko, interval=24 * 60 * 60,
+                 ranking_size=250, download=True):
+        # Without download, the list is only read again when another
+        # process has downloaded a newer one
+        super().__init__(name='coin-index', daemon=True)
+        self.index = index
+        self.coinGecko = coinGecko
+        self.interval = interval  # Seconds between downloads
+        self.ranking_size = ranking_size  # Coins preferred when ambiguous
+        self.download = download
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                logging.warning('Coin index failed to refresh')
+                self.stopped.wait(5 * 60)
+                continue
+
+            # Processes not downloading check for a new list every minute
+            wait = 60
+            if self.download:
+                wait = max(self.interval - (self.index.age() or 0), wait)
+            self.stopped.wait(wait)
+
+    def refresh(self):
+        # If another process downloaded the list recently, just read it
+        age = self.index.age()
+        if not self.download or (age is not None and age < self.interval):
+            if age is not None and (self.index.updated is None or
+                                    time.time() - self.index.updated >
+                                    age + 1):
+                self.index.load()
+            return
+
+        with self.coinGecko.background():
+            coins = self.coinGecko.coins_list()
+            markets = self.coinGecko.coins_markets(
+                'usd', self.ranking_size, order='market_cap_desc'
+            )
+        if len(coins) == 0:
+            raise ValueError('Empty coin list')
+        self.index.update(coins, [market.id for market in markets])
+        logging.info('Coin index updated [' + str(len(coins)) + ' coins]')
+
+    def stop(self):
+        self.stopped.set()
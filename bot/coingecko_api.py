@@ -1,4 +1,317 @@
+import collections
+import contextlib
+import logging
+import math
+import threading
+import time
 import requests
+import http_session
+import metrics
+import rate_limit
+import series
+
+one_day = 24 * 60 * 60 * 1000  # Milliseconds
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class TTLCache:
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()  # Key -> (expiration, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+
+    def get(self, key, stale=False):
+        # Returns a (found, value) tuple. Expired entries are only found with
+        # stale, when nothing fresher can be obtained
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (entry[0] <= time.monotonic() and not stale):
+                if not stale:
+                    self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)  # Most recently used goes last
+            if stale:
+                self.stale_hits += 1
+            else:
+                self.hits += 1
+            return True, entry[1]
+
+    def put(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+
+            # Evict the least recently used entries
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def dump(self):
+        # (key, expiration, value) of every entry, least recently used first.
+        # Expirations are wall clock times, valid in another process
+        offset = time.time() - time.monotonic()
+        with self.lock:
+            return [(key, expiration + offset, value)
+                    for key, (expiration, value) in self.entries.items()]
+
+    def restore(self, entries, max_stale=60 * 60):
+        # Entries expired more than max_stale seconds ago are left out
+        now = time.time()
+        for key, expiration, value in entries:
+            if expiration > now - max_stale:
+                self.put(key, value, expiration - now)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'stale_hits': self.stale_hits,
+                    'hit_ratio': self.hits / total if total > 0 else 0.0,
+                    'size': len(self.entries)}
+
+
+class SingleFlight:
+
+    class Call:
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # Key -> call in progress
+        self.shared = 0  # Callers that got the result of someone else's call
+
+    def do(self, key, function):
+        # Run the function, unless an identical call is already in progress.
+        # In that case, wait for it and share its result (or its exception)
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = SingleFlight.Call()
+                self.calls[key] = call
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        with self.lock:
+            return {'in_flight': len(self.calls), 'shared': self.shared}
+
+
+class PriceBatcher:
+
+    class Batch:
+
+        def __init__(self):
+            self.coins = []
+            self.closed = threading.Event()  # No more coins can be added
+            self.done = threading.Event()
+            self.prices = {}
+            self.error = None
+
+    def __init__(self, fetch, window=0.05, max_coins=100):
+        self.fetch = fetch  # Receives a list of coins, returns coin -> prices
+        self.window = window  # Seconds a batch waits for more coins
+        self.max_coins = max_coins
+        self.lock = threading.Lock()
+        self.open = {}  # Lane -> batch still collecting coins
+        self.batches = 0
+        self.requested = 0
+
+    def get(self, coins, lane=None):
+        # The first caller of a batch waits for the window to finish and then
+        # resolves every coin collected in the meantime. Other callers only
+        # add their coins and wait for the result. Callers only share
+        # batches with callers of the same lane
+        with self.lock:
+            self.requested += len(coins)
+            batch = self.open.get(lane)
+            if batch is not None:
+                new_coins = [c for c in coins if c not in batch.coins]
+                if len(batch.coins) + len(new_coins) > self.max_coins:
+                    batch.closed.set()  # Full, start a new one
+                    batch = None
+            leader = batch is None
+            if leader:
+                batch = PriceBatcher.Batch()
+                self.open[lane] = batch
+                self.batches += 1
+                new_coins = list(coins)
+            batch.coins.extend(new_coins)
+
+        if leader:
+            batch.closed.wait(self.window)
+            with self.lock:
+                if self.open.get(lane) is batch:
+                    del self.open[lane]
+            try:
+                batch.prices = self.fetch(batch.coins)
+            except Exception as error:
+                batch.error = error
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        return {c: batch.prices[c] for c in coins if c in batch.prices}
+
+    def stats(self):
+        with self.lock:
+            return {'batches': self.batches, 'coins': self.requested}
+
+
+class MarketData:
+
+    # Market fields of a coin, out of the whole coins/{id} document
+    __slots__ = ('market_cap', 'circulating_supply', 'total_supply',
+                 'price_change')
+
+    intervals = ('1h', '24h', '7d', '14d', '30d', '60d', '200d', '1y')
+
+    def __init__(self, market_cap, circulating_supply, total_supply,
+                 price_change):
+        self.market_cap = market_cap  # Currency -> market cap
+        self.circulating_supply = circulating_supply
+        self.total_supply = total_supply
+        self.price_change = price_change  # Interval -> currency -> %
+
+    @classmethod
+    def parse(cls, document, currencies):
+        # None if the coin doesn't exist
+        data = document.get('market_data')
+        if data is None:
+            return None
+        price_change = {}
+        for interval in cls.intervals:
+            changes = data.get('price_change_percentage_' + interval +
+                               '_in_currency') or {}
+            price_change[interval] = {currency: changes[currency]
+                                      for currency in currencies
+                                      if currency in changes}
+        market_cap = data.get('market_cap') or {}
+        return cls({currency: market_cap[currency] for currency in currencies
+                    if currency in market_cap},
+                   data.get('circulating_supply'), data.get('total_supply'),
+                   price_change)
+
+
+class CoinInfo:
+
+    # The fields of coins/{id} that !info shows
+    __slots__ = ('name', 'symbol', 'homepage', 'twitter', 'facebook',
+                 'telegram', 'subreddit', 'genesis_date', 'rank',
+                 'block_time')
+
+    def __init__(self, name, symbol, homepage, twitter, facebook, telegram,
+                 subreddit, genesis_date, rank, block_time):
+        self.name = name
+        self.symbol = symbol
+        self.homepage = homepage
+        self.twitter = twitter  # Screen name
+        self.facebook = facebook  # User name
+        self.telegram = telegram  # Channel identifier
+        self.subreddit = subreddit  # URL
+        self.genesis_date = genesis_date  # YYYY-MM-DD
+        self.rank = rank
+        self.block_time = block_time  # Minutes
+
+    @classmethod
+    def parse(cls, document):
+        # None if the coin doesn't exist
+        if 'error' in document or 'name' not in document:
+            return None
+        links = document.get('links') or {}
+        homepage = [url for url in links.get('homepage') or [] if url]
+        return cls(document['name'], document.get('symbol', ''),
+                   homepage[0] if len(homepage) > 0 else '',
+                   links.get('twitter_screen_name') or '',
+                   links.get('facebook_username') or '',
+                   links.get('telegram_channel_identifier') or '',
+                   links.get('subreddit_url') or '',
+                   document.get('genesis_date'),
+                   document.get('coingecko_rank'),
+                   document.get('block_time_in_minutes'))
+
+
+class Market:
+
+    # A coin in coins/markets, which has dozens of fields
+    __slots__ = ('id', 'name', 'current_price', 'market_cap',
+                 'price_change_24h')
+
+    def __init__(self, id, name, current_price, market_cap,
+                 price_change_24h):
+        self.id = id
+        self.name = name
+        self.current_price = current_price
+        self.market_cap = market_cap
+        self.price_change_24h = price_change_24h  # %
+
+    @classmethod
+    def parse(cls, document):
+        # Coins of the answer, none if it's an error
+        if not isinstance(document, list):
+            return []
+        return [cls(coin['id'], coin['name'], coin.get('current_price'),
+                    coin.get('market_cap'),
+                    coin.get('price_change_percentage_24h'))
+                for coin in document]
+
+
+def chart_step(days):
+    # Milliseconds between points CoinGecko returns for that number of days
+    if days <= 1:
+        return 5 * 60 * 1000
+    if days <= 90:
+        return 60 * 60 * 1000
+    return one_day
+
+
+def _endpoint(path):
+    # Path without the coin, to group the requests of every coin together
+    parts = path.split('/')
+    if parts[0] == 'coins' and len(parts) > 1 and \
+            parts[1] not in ('list', 'markets'):
+        parts[1] = '{id}'
+    return '/'.join(parts)
+
+
+def _days(days):
+    # Days as CoinGecko expects them ("30" instead of "30.0")
+    return str(int(days)) if days == int(days) else str(days)
 
 
 class CoinGeckoRequester:
@@ -6,60 +319,365 @@ class CoinGeckoRequester:
     url_v3 = 'https://api.coingecko.com/api/v3/'
     commonCurrencies = ['usd', 'eur', 'gbp', 'cad', 'chf', 'aud', 'inr']
 
-    def __init__(self, url=url_v3, currencies=commonCurrencies):
+    # Seconds a response of each endpoint is considered fresh
+    freshness = {'simple_price': 30,
+                 'market_chart': 300,
+                 'market_data': 60,
+                 'coin_info': 6 * 60 * 60,
+                 'coins_markets': 60,
+                 'coins_list': 6 * 60 * 60}
+
+    def __init__(self, url=url_v3, currencies=commonCurrencies,
+                 cache_size=1024, ttl=freshness, batch_window=0.05,
+                 pool_size=10, connect_timeout=5, read_timeout=20,
+                 retries=3, store=None, scheduler=None, attempts=4,
+                 queue_timeout=10, cache=None, popular=None):
         self.url = url
+        self.store = store  # Local copy of the market charts
+        self.covered = {}  # Stored series -> first day asked to CoinGecko
+        # Error answers are retried here, so the session only retries
+        # connection errors
+        self.session = http_session.create_session(pool_size, retries,
+                                                   retry_statuses=())
+        self.timeout = (connect_timeout, read_timeout)
+
+        # Every request waits for a token of the shared scheduler. Users
+        # wait at most queue_timeout seconds, then stale data is served
+        if scheduler is None:
+            scheduler = rate_limit.Scheduler()
+        self.scheduler = scheduler
+        self.attempts = attempts
+        self.queue_timeout = queue_timeout
+        self.local = threading.local()  # Priority of each thread
         self.currencies = currencies
         self.currenciesText = ",".join(currencies)
+        # Any object with the interface of TTLCache, like a cache shared
+        # with other processes
+        self.cache = cache if cache is not None else TTLCache(cache_size)
+        self.ttl = ttl
+        self.flights = SingleFlight()
+        self.batcher = PriceBatcher(self._fetch_prices, batch_window)
+        # Coin -> times asked. Like the cache, it can be shared with other
+        # processes
+        self.popular = popular if popular is not None else \
+            collections.Counter()
+        self.popular_lock = threading.Lock()
+
+    def _get(self, endpoint, path, params, refresh=False, ttl=None,
+             parse=None):
+        # Same path and same params always get the same cached response.
+        # With refresh, the cache is skipped and updated with a new response
+        # that stays fresh for ttl seconds (the endpoint's TTL by default).
+        # parse turns the JSON into what is cached and returned, so only the
+        # fields used are kept
+        key = (path, tuple(sorted(params.items())))
+        if not refresh:
+            found, response_json = self.cache.get(key)
+            if found:
+                return response_json
+
+        # Identical requests running at the same time share a single call.
+        # The leader's priority decides how long the call waits for the
+        # scheduler, so users never join a call of the background threads,
+        # which can wait without limit
+        try:
+            return self.flights.do(
+                (self._priority(),) + key,
+                lambda: self._fetch(endpoint, path, params, key, ttl, parse)
+            )
+        except UpstreamError:
+            # Degraded mode: an old answer is better than no answer
+            found, response_json = self.cache.get(key, stale=True)
+            if found:
+                return response_json
+            raise
+
+    def _fetch(self, endpoint, path, params, key, ttl=None, parse=None):
+        status, response_json = self._request(path, params)
+        if parse is not None:
+            response_json = parse(response_json)
+
+        # "Not found" answers are cached too, but never rate limits or errors
+        if status in (200, 404):
+            self.cache.put(key, response_json, ttl or self.ttl[endpoint])
+        return response_json
+
+    def _request(self, path, params):
+        # Rate limits, server errors and answers that aren't JSON are tried
+        # again, waiting longer after every attempt
+        priority = self._priority()
+        timeout = None
+        if priority == rate_limit.INTERACTIVE:
+            timeout = self.queue_timeout
+
+        for attempt in range(self.attempts):
+            if attempt > 0:
+                time.sleep(rate_limit.backoff(attempt - 1))
+            if not self.scheduler.acquire(priority, timeout):
+                raise UpstreamError('No CoinGecko request budget left')
+
+            start = time.monotonic()
+            try:
+                response = self.session.get(self.url + path, params=params,
+                                            timeout=self.timeout)
+            except requests.RequestException:
+                metrics.upstream_seconds.observe(time.monotonic() - start,
+                                                 'coingecko', _endpoint(path),
+                                                 'error')
+                continue
+            metrics.upstream_seconds.observe(time.monotonic() - start,
+                                             'coingecko', _endpoint(path),
+                                             str(response.status_code))
+
+            if response.status_code == 429:
+                self.scheduler.block(rate_limit.retry_after(
+                    response.headers, rate_limit.backoff(attempt, base=10)
+                ))
+                continue
+            if response.status_code >= 500:
+                continue
+
+            try:
+                return response.status_code, response.json()
+            except ValueError:
+                continue
+
+        raise UpstreamError('CoinGecko failed ' + str(self.attempts) +
+                            ' times [' + path + ']')
+
+    def _priority(self):
+        return getattr(self.local, 'priority', rate_limit.INTERACTIVE)
+
+    @contextlib.contextmanager
+    def background(self):
+        # Requests sent inside this block wait for the interactive ones
+        previous = self._priority()
+        self.local.priority = rate_limit.BACKGROUND
+        try:
+            yield
+        finally:
+            self.local.priority = previous
+
+    def _fetch_prices(self, coins, ttl=None):
+        # Prices of several coins with a single request. Every coin is cached
+        # on its own, so later requests can mix cached and new coins
+        params = {'ids': ','.join(coins), 'vs_currencies': self.currenciesText}
+        status, response_json = self._request('simple/price', params)
+
+        prices = {}
+        if status != 200:
+            return prices
+
+        for coin in coins:
+            price = response_json.get(coin, [])
+            self.cache.put(('simple/price', coin), price,
+                           ttl or self.ttl['simple_price'])
+            if len(price) > 0:
+                prices[coin] = price
+        return prices
+
+    def cache_stats(self):
+        return self.cache.stats()
+
+    def flight_stats(self):
+        return self.flights.stats()
+
+    def scheduler_stats(self):
+        return self.scheduler.stats()
+
+    def batch_stats(self):
+        return self.batcher.stats()
+
+    def connection_stats(self):
+        return http_session.connection_stats(self.session)
+
+    def most_queried(self, limit):
+        # Coins users asked about the most (only the ones that exist)
+        with self.popular_lock:
+            return [coin for coin, _ in self.popular.most_common(limit)]
+
+    def _record(self, coins):
+        with self.popular_lock:
+            self.popular.update(coins)
+
+    def dump_popular(self):
+        with self.popular_lock:
+            return dict(self.popular.items())
+
+    def restore_popular(self, counts):
+        with self.popular_lock:
+            self.popular.update(counts)
 
     def simple_price(self, coin):
-        params = {'ids': coin, 'vs_currencies': self.currenciesText}
-        response = requests.get(self.url + 'simple/price', params)
-        response_json = response.json()
-        if coin in response_json:
-            return response_json[coin]
+        prices = self.simple_prices([coin])
+        if coin in prices:
+            return prices[coin]
         else:
             return []
 
-    def market_chart(self, coin, currency, days):
+    def simple_prices(self, coins, refresh=False, ttl=None):
+        # Coin -> prices, leaving out the coins that don't exist. Coins not
+        # cached are joined with the ones asked by other chats at the same
+        # time and resolved with a single request
+        if refresh:
+            return self._fetch_prices(list(coins), ttl)
+
+        prices = {}
+        missing = []
+        for coin in coins:
+            found, price = self.cache.get(('simple/price', coin))
+            if not found:
+                if coin not in missing:
+                    missing.append(coin)
+            elif len(price) > 0:
+                prices[coin] = price
+
+        if len(missing) > 0:
+            try:
+                # Users and background threads never share a batch, like
+                # in _get
+                prices.update(self.batcher.get(missing, self._priority()))
+            except UpstreamError:
+                # Degraded mode: serve old prices of the coins that have any
+                stale = 0
+                for coin in missing:
+                    found, price = self.cache.get(('simple/price', coin),
+                                                  stale=True)
+                    if found:
+                        stale += 1
+                        if len(price) > 0:
+                            prices[coin] = price
+                if stale == 0:
+                    raise
+        self._record(list(prices))
+        return prices
+
+    def market_chart(self, coin, currency, days, as_arrays=False):
+        # With as_arrays, returns a (timestamps, prices) pair of NumPy arrays
+        # instead of a list of [milliseconds, price] points
+        if as_arrays and self.store is not None:
+            stored = self._stored_chart(coin, currency, days)
+            if stored is not None:
+                return stored
+
+        points = self._chart_points(coin, currency, days)
+        if as_arrays:
+            return series.from_points(points)
+        return points
+
+    def _chart_points(self, coin, currency, days):
         params = {'vs_currency': currency, 'days': days}
-        response = requests.get(self.url + 'coins/' + coin + '/market_chart',
-                                params)
-        response_json = response.json()
+        response_json = self._get('market_chart',
+                                  'coins/' + coin + '/market_chart', params)
         if 'prices' in response_json:
             return response_json['prices']
         else:
             return []
 
-    def market_data(self, coin):
-        params = {'tickers': False,
+    def _stored_chart(self, coin, currency, days):
+        # Serve the series from the local store, asking CoinGecko only for the
+        # points newer than the stored ones. None if it can't be stored
+        try:
+            days = float(days)
+        except ValueError:
+            return None  # "max"
+        if not 0 < days < 100000 or not self.store.valid(coin, currency):
+            return None
+
+        step = chart_step(days)
+        now = int(time.time() * 1000)
+        start = now - int(days * one_day)
+        key = (coin, currency, step)
+
+        with self.store.series_lock(coin, currency, step):
+            first, last = self.store.bounds(coin, currency, step)
+
+            # Days since the last point stored. If CoinGecko answers them
+            # with another resolution (or there's nothing left of the
+            # period), the whole series is asked again
+            missing = None
+            if last is not None:
+                missing = max(math.ceil((now - last) / one_day), 1)
+
+            # The store must go back to start, unless the coin is younger
+            if first is None or last < start or \
+                    chart_step(missing) != step or \
+                    (first > start + step and
+                     self.covered.get(key, now) > start):
+                timestamps, prices = series.from_points(
+                    self._chart_points(coin, currency, _days(days))
+                )
+                if len(timestamps) == 0:
+                    return timestamps, prices  # Coin not found
+                self.store.replace(coin, currency, step, timestamps, prices)
+                self.covered[key] = start
+
+            # Only the tail is missing. Its answer is cached for the TTL of
+            # the market charts, so it's asked at most once per TTL
+            else:
+                try:
+                    tail = series.from_points(
+                        self._chart_points(coin, currency, str(missing))
+                    )
+                except UpstreamError:
+                    # Degraded mode: the stored series, without its tail
+                    logging.warning('CoinGecko API failed, chart served ' +
+                                    'from the store [' + coin + ']')
+                    tail = series.empty()
+                self.store.append(coin, currency, step, *tail)
+
+                # The latest price, even if it's closer than a step to the
+                # last point stored
+                timestamps, prices = self.store.read(coin, currency, step,
+                                                     start)
+                if len(tail[0]) > 0 and (len(timestamps) == 0 or
+                                         tail[0][-1] > timestamps[-1]):
+                    return series.add_point(timestamps, prices,
+                                            tail[0][-1], tail[1][-1])
+                return timestamps, prices
+
+            return self.store.read(coin, currency, step, start)
+
+    def market_data(self, coin, refresh=False, ttl=None):
+        # MarketData of the coin, None if it doesn't exist. coins/markets
+        # only answers one currency per request and misses some intervals,
+        # so the document of the coin is asked, without translations
+        params = {'localization': False,
+                  'tickers': False,
                   'community_data': False,
-                  'developer_data': False}
-        response = requests.get(self.url + 'coins/' + coin, params)
-        response_json = response.json()
-        if 'market_data' in response_json:
-            return response_json['market_data']
-        else:
-            return []
+                  'developer_data': False,
+                  'sparkline': False}
+        market_data = self._get(
+            'market_data', 'coins/' + coin, params, refresh, ttl,
+            lambda document: MarketData.parse(document, self.currencies)
+        )
+        if market_data is not None and not refresh:
+            self._record([coin])
+        return market_data
 
     def coin_info(self, coin):
-        params = {'tickers': False,
+        # CoinInfo of the coin, None if it doesn't exist
+        params = {'localization': False,
+                  'tickers': False,
                   'community_data': False,
                   'developer_data': False,
-                  'market_data': False}
-        response = requests.get(self.url + 'coins/' + coin, params)
-        response_json = response.json()
-        if 'error' in response_json:
-            return []
-        else:
-            return response_json
+                  'market_data': False,
+                  'sparkline': False}
+        return self._get('coin_info', 'coins/' + coin, params,
+                         parse=CoinInfo.parse)
 
-    def coins_markets(self, coin, limit):
-        params = {'vs_currency': coin,
+    def coins_markets(self, currency, limit, order='gecko_desc'):
+        # Market of the first limit coins
+        params = {'vs_currency': currency,
                   'per_page': limit,
-                  'order': 'gecko_desc',
+                  'order': order,
                   'sparkline': False}
-        response = requests.get(self.url + 'coins/markets', params)
-        response_json = response.json()
+        return self._get('coins_markets', 'coins/markets', params,
+                         parse=Market.parse)
+
+    def coins_list(self):
+        # Id, symbol and name of every coin (thousands of them)
+        response_json = self._get('coins_list', 'coins/list', {})
         if 'error' in response_json:
             return []
         else:
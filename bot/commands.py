@@ -0,0 +1,917 @@
+import datetime
+import charts
+import series
+import telegram_api
+
+# Equivalence between currencies and emojis
+emoji_map = {'chf': '🇨🇭', 'inr': '🇮🇳', 'eur': '🇪🇺', 'cad': '🇨🇦',
+             'aud': '🇦🇺', 'gbp': '🇬🇧', 'usd': '🇺🇸'}
+# Equivalence between currencies and signs
+sign_map = {'chf': 'CHF', 'inr': '₹', 'eur': '€', 'cad': '$',
+            'aud': '$', 'gbp': '£', 'usd': '$'}
+
+unavailable = 'The service is unavailable, try again later'
+
+
+class InvalidFormat(Exception):
+
+    def __init__(self, reply=None):
+        # Reply sent to the user, "Invalid format" by default
+        super().__init__()
+        if reply is None:
+            reply = Text('Invalid format', ok=False)
+        self.reply = reply
+
+
+class Unavailable(Exception):
+    pass
+
+
+class Context:
+
+    # Everything the commands need to build their replies. Messages are sent
+    # through a SendQueue
+    def __init__(self, bot, coinGecko, renderer, chart_cache, coins=None,
+                 alerts=None, portfolios=None):
+        self.bot = bot
+        self.coinGecko = coinGecko
+        self.renderer = renderer
+        self.chart_cache = chart_cache
+        self.coins = coins  # CoinIndex, coin names are used as ids without it
+        self.alerts = alerts  # AlertStore, without it there are no alerts
+        self.portfolios = portfolios  # PortfolioStore of the watchlists
+
+
+# ================================ REPLIES ================================= #
+class Text:
+
+    def __init__(self, text, markdown=False, ok=True):
+        self.text = text
+        self.markdown = markdown
+        self.ok = ok  # False if the user asked for something wrong
+
+    def send(self, context, chat_id):
+        if self.markdown:
+            context.bot.send_markdown_message(chat_id, self.text)
+        else:
+            context.bot.send_message(chat_id, self.text)
+
+
+class Chart:
+
+    ok = True
+
+    def __init__(self, key, png, file_id=None):
+        self.key = key  # Key in the chart cache
+        self.png = png
+        self.file_id = file_id
+
+    def send(self, context, chat_id):
+        # Charts already uploaded are sent again by their Telegram identifier.
+        # If Telegram doesn't know it anymore, the PNG is uploaded instead
+        if self.file_id is None:
+            self._upload(context, chat_id)
+            return
+
+        def sent(response):
+            if telegram_api.photo_file_id(response) is None:
+                self._upload(context, chat_id, first=True)
+
+        context.bot.send_photo(chat_id, self.file_id, callback=sent)
+
+    def _upload(self, context, chat_id, first=False):
+        def uploaded(response):
+            context.chart_cache.set_file_id(
+                self.key, telegram_api.photo_file_id(response)
+            )
+
+        context.bot.send_photo(chat_id, self.png, callback=uploaded,
+                               first=first)
+
+
+# =============================== COMMANDS ================================= #
+class Command:
+
+    name = None
+    needs_arguments = True
+    upstream = None  # Data fetched, to know what failed in the logs
+    max_concurrent = None  # Limit of commands of this type running at once
+
+    def parse(self, argument, message):
+        # Parameters of the command. Raises InvalidFormat if they're wrong
+        return {}
+
+    def resolve(self, context, params):
+        # Turn the coins of the parameters into CoinGecko ids, without
+        # asking upstream. Raises InvalidFormat if a coin doesn't exist
+        pass
+
+    def fetch(self, context, params):
+        # Upstream data needed by the command. Any exception means the
+        # service is unavailable
+        return None
+
+    def format(self, context, params, data):
+        # Reply to send (Text or Chart). Raises InvalidFormat if the data
+        # shows the parameters were wrong, or Unavailable if something else
+        # than the upstream failed
+        raise NotImplementedError
+
+
+# ======================= BASIC COMMANDS ======================= #
+class StartCommand(Command):
+
+    name = '/start'
+    needs_arguments = False
+
+    def parse(self, argument, message):
+        return {'first_name': message['chat']['first_name']}
+
+    def format(self, context, params, data):
+        return Text("Hey " + params['first_name'] +
+                    "! I'm here to help you manage cryptocurrency " +
+                    "information. Use /help to find out more about how to " +
+                    "interact with me")
+
+
+class HelpCommand(Command):
+
+    name = '/help'
+    needs_arguments = False
+
+    def format(self, context, params, data):
+        output = "You can control me by sending these commands. " + \
+            "Coins can be written by name, symbol or CoinGecko id\n\n" + \
+            "*!price [coin]* - Current price of the " + \
+            "cryptocurrency. Several coins can be asked at once. " + \
+            "For example: `!price bitcoin` or " + \
+            "`!price bitcoin ethereum solana`\n\n" + \
+            "*!info [coin]* - Basic information about the " + \
+            "cryptocurrency. " + \
+            "For example: `!info bitcoin`\n\n" + \
+            "*!price_change [interval] [coin]* - Price change " + \
+            "percentage of the cryptocurrency within an interval. " + \
+            "The interval must be 1h, 24h, 7d, 24d, 30d, 60d, " + \
+            "200d or 1y. " + \
+            "For example: `!price_change 7d bitcoin`\n\n" + \
+            "*!evolution [days] [currency] [coin]* - Price " + \
+            "evolution of a coin converted into a currency. " + \
+            "The currency must be chf, inr, eur, cad, aud, gbp " + \
+            "or usd. " + \
+            "For example: `!evolution 15 usd bitcoin`\n\n" + \
+            "*!top_coins [currency]* - Image showing the price " + \
+            "change of the top 10 cryptocurrencies in the last 24 " + \
+            "hours. The currency must be chf, inr, eur, cad, aud, " + \
+            "gbp or usd. " + \
+            "For example: `!top_coins usd`\n\n" + \
+            "*!evolution_img [days] [currency] [coin]* - Image " + \
+            "showing the price evolution of a coin converted into " + \
+            "a currency. The currency must be chf, inr, eur, cad, " + \
+            "aud, gbp or usd. " + \
+            "For example: `!evolution_img 365 usd bitcoin`\n\n" + \
+            "*!market_cap [coin]* - Market capitalization of the " + \
+            "cryptocurrency. " + \
+            "For example: `!market_cap bitcoin`\n\n" + \
+            "*!supply [coin]* - Current supply for the " + \
+            "cryptocurrency. " + \
+            "For example: `!supply bitcoin`\n\n" + \
+            "*!alert [coin] [> or <] [price] [currency]* - Notify " + \
+            "once when the price of the coin goes above or below a " + \
+            "value. The currency is usd if not given. " + \
+            "For example: `!alert bitcoin > 70000 usd`\n\n" + \
+            "*!alerts* - Alerts waiting to be notified\n\n" + \
+            "*!alert_delete [id]* - Delete an alert. " + \
+            "For example: `!alert_delete 3`\n\n" + \
+            "*!watch add [coin] [amount]* - Add a coin to your " + \
+            "watchlist, optionally with the amount you hold. " + \
+            "For example: `!watch add bitcoin 0.5`\n\n" + \
+            "*!watch remove [coin]* - Remove a coin from your " + \
+            "watchlist. For example: `!watch remove bitcoin`\n\n" + \
+            "*!watchlist [currency]* - Current price of every coin " + \
+            "of your watchlist. The currency is usd if not given. " + \
+            "For example: `!watchlist eur`\n\n" + \
+            "*!portfolio [currency]* - Value of the coins you hold. " + \
+            "For example: `!portfolio usd`"
+        return Text(output, markdown=True)
+
+
+# ====================== SIMPLE PRICE ====================== #
+class PriceCommand(Command):
+
+    name = '!price'
+    upstream = 'Simple price'
+
+    def parse(self, argument, message):
+        # Convert spaces in the name of the coin into hyphens. Several
+        # words can also be several coins ("!price bitcoin ethereum"),
+        # so every option is asked in the same request
+        words = argument.split()
+        coin = '-'.join(words)
+        candidates = [coin]
+        if len(words) > 1:
+            candidates = candidates + words
+        return {'argument': argument, 'coin': coin,
+                'words': [(word, word) for word in words],
+                'candidates': candidates}
+
+    def resolve(self, context, params):
+        # The whole argument may be a name ("bitcoin cash") or a symbol.
+        # Otherwise, every word is a coin
+        if not has_index(context):
+            return
+        coin = context.coins.resolve(params['argument'])
+        if coin is not None:
+            params['coin'] = coin
+            params['candidates'] = [coin]
+            return
+
+        params['words'] = [(word, context.coins.resolve(word))
+                           for word, _ in params['words']]
+        params['candidates'] = [coin for _, coin in params['words']
+                                if coin is not None]
+        if len(params['candidates']) == 0:
+            raise InvalidFormat(not_found(context, params['argument']))
+
+    def fetch(self, context, params):
+        return context.coinGecko.simple_prices(params['candidates'])
+
+    def format(self, context, params, response):
+        words = params['words']
+        several_coins = params['coin'] not in response
+        if several_coins:
+            coins = []
+            for _, coin in words:
+                if coin in response and coin not in coins:
+                    coins.append(coin)
+        else:
+            coins = [params['coin']]
+
+        if len(coins) == 0:
+            return not_found(context, params['argument'])
+
+        sections = []
+
+        # Build the response
+        for coin in coins:
+            section = 'The current *' + coin + '* price is:\n'
+            for currency in response[coin]:
+                section = section + \
+                    emoji_map[currency] + ' ' + \
+                    formatNumber(response[coin][currency]) + ' ' + \
+                    sign_map[currency] + \
+                    '\n'
+            sections.append(section)
+
+        # Some of the coins asked may not exist
+        for word, coin in words:
+            if several_coins and coin not in response:
+                sections.append('*' + word + '* not found\n')
+        return Text('\n'.join(sections), markdown=True)
+
+
+# ====================== MARKET CHART ====================== #
+class EvolutionCommand(Command):
+
+    name = '!evolution'
+    upstream = 'Market chart'
+
+    def parse(self, argument, message):
+        # evolution_args[0] -> days
+        # evolution_args[1] -> currency
+        # evolution_args[2] -> coin
+        evolution_args = argument.strip().split(" ", 2)
+        if len(evolution_args) != 3:
+            raise InvalidFormat()
+
+        return {'days': evolution_args[0],
+                'currency': evolution_args[1],
+                'name': evolution_args[2].strip(),
+                'coin': evolution_args[2].strip().replace(' ', '-')}
+
+    def resolve(self, context, params):
+        resolve_coin(context, params)
+
+    def fetch(self, context, params):
+        if params['currency'] not in sign_map:
+            return series.empty()
+        return context.coinGecko.market_chart(
+            params['coin'], params['currency'], params['days'],
+            as_arrays=True
+        )
+
+    def format(self, context, params, data):
+        timestamps, prices = data
+        if len(timestamps) == 0:
+            raise InvalidFormat()
+        currency = params['currency']
+
+        # Return only 12 values
+        timestamps, prices = series.resample(timestamps, prices, 12)
+
+        # Check if the price has increased or not
+        tendencies = series.tendencies(prices)
+
+        # Build the response
+        output = 'Evolution of *' + params['name'] + \
+                 '* in the last ' + params['days'] + ' day(s)' + \
+                 ' ' + emoji_map[currency] + '\n\n'
+        for timestamp, price, tendency in zip(timestamps, prices,
+                                              tendencies):
+
+            # Convert the time deleting milliseconds
+            date = datetime.datetime \
+                .fromtimestamp(timestamp // 1000) \
+                .strftime('%d/%m/%Y -- %H:%M')
+
+            # Get all together
+            output = output + \
+                '_' + str(date) + '_\n' + \
+                tendency + ' ' + \
+                formatNumber(float(price)) + ' ' + \
+                sign_map[currency] + '\n\n'
+
+        return Text(output, markdown=True)
+
+
+# ================ MARKET CHART WITH IMAGE ================= #
+class EvolutionImageCommand(EvolutionCommand):
+
+    name = '!evolution_img'
+    max_concurrent = 4
+
+    def fetch(self, context, params):
+        # The same chart drawn recently is reused
+        key = charts.evolution_key(params['coin'], params['currency'],
+                                   params['days'])
+        cached = context.chart_cache.get(key)
+        if cached is not None:
+            return {'key': key, 'cached': cached}
+
+        return {'key': key,
+                'cached': None,
+                'chart': EvolutionCommand.fetch(self, context, params)}
+
+    def format(self, context, params, data):
+        if data['cached'] is not None:
+            return Chart(data['key'], *data['cached'])
+
+        timestamps, prices = data['chart']
+        if len(timestamps) == 0:
+            raise InvalidFormat()
+
+        title = 'Evolution of ' + params['name'] + \
+                ' in the last ' + params['days'] + ' day(s)'
+
+        # y-axis showing currency
+        try:
+            photo = context.renderer.render(charts.evolution_chart,
+                                            timestamps, prices,
+                                            title, params['currency'])
+        except Exception:
+            raise Unavailable('Chart rendering failed [Evolution]')
+
+        context.chart_cache.put(data['key'], photo)
+        return Chart(data['key'], photo)
+
+
+# ====================== PRICE CHANGE ====================== #
+class PriceChangeCommand(Command):
+
+    name = '!price_change'
+    upstream = 'Market data'
+    allowed_interval = {'1h', '24h', '7d', '14d', '30d', '60d', '200d', '1y'}
+
+    def parse(self, argument, message):
+        # price_change[0] -> interval
+        # price_change[1] -> coin
+        price_change = argument.strip().split(" ", 1)
+        if len(price_change) != 2:
+            raise InvalidFormat()
+
+        interval = price_change[0]
+        if interval not in self.allowed_interval:
+            raise InvalidFormat(Text('Interval must be ' +
+                                     '`1h`, `24h`, `7d`, `24d`, `30d`, ' +
+                                     '`60d`, `200d` or `1y`',
+                                     markdown=True, ok=False))
+
+        return {'interval': interval,
+                'name': price_change[1].strip(),
+                'coin': price_change[1].strip().replace(' ', '-')}
+
+    def resolve(self, context, params):
+        resolve_coin(context, params)
+
+    def fetch(self, context, params):
+        return context.coinGecko.market_data(params['coin'])
+
+    def format(self, context, params, response):
+        coin = params['coin']
+        interval = params['interval']
+        if response is None:
+            return not_found(context, params['name'])
+
+        data = response.price_change[interval]
+        output = 'Price change of *' + coin + \
+                 '* in the last _' + interval + '_:\n'
+
+        # Build the response
+        for currency in data:
+            if currency in sign_map:
+                value = formatNumber(data[currency]) + '%'
+                if data[currency] > 0:
+                    value = '+' + value
+                output = output + \
+                    emoji_map[currency] + ' ' + \
+                    value + ' ' + \
+                    sign_map[currency] + \
+                    '\n'
+        return Text(output, markdown=True)
+
+
+# =========== 24H TOP CRYPTOCURRENCIES WITH IMAGE ========== #
+class TopCoinsCommand(Command):
+
+    name = '!top_coins'
+    upstream = 'Top coins'
+    max_concurrent = 4
+
+    def parse(self, argument, message):
+        currency = argument
+        if currency not in sign_map:
+            raise InvalidFormat(Text("The currency must be chf, inr, eur, " +
+                                     "cad, aud, gbp or usd", ok=False))
+        return {'currency': currency}
+
+    def fetch(self, context, params):
+        key = charts.top_coins_key(params['currency'])
+        cached = context.chart_cache.get(key)
+        if cached is not None:
+            return {'key': key, 'cached': cached}
+
+        return {'key': key,
+                'cached': None,
+                'coins': context.coinGecko.coins_markets(params['currency'],
+                                                         10)}
+
+    def format(self, context, params, data):
+        if data['cached'] is not None:
+            return Chart(data['key'], *data['cached'])
+
+        x = []
+        y = []
+        colors = []
+
+        for crypto in data['coins']:
+            x.append(crypto.name)
+            change = crypto.price_change_24h
+            y.append(change)
+            if change < 0:
+                colors.append('r')  # Red color
+            else:
+                colors.append('g')  # Green color
+
+        try:
+            photo = context.renderer.render(charts.bar_chart, x, y, colors,
+                                            '24 hours price change of the' +
+                                            ' top 10 cryptocurrencies',
+                                            '% in ' + params['currency'])
+        except Exception:
+            raise Unavailable('Chart rendering failed [Top coins]')
+
+        if len(data['coins']) > 0:
+            context.chart_cache.put(data['key'], photo)
+        return Chart(data['key'], photo)
+
+
+# ======================= MARKET CAP ======================= #
+class MarketCapCommand(Command):
+
+    name = '!market_cap'
+    upstream = 'Market data'
+
+    def parse(self, argument, message):
+        # Convert spaces in the name of the coin into hyphens
+        return {'name': argument.strip(),
+                'coin': argument.strip().replace(' ', '-')}
+
+    def resolve(self, context, params):
+        resolve_coin(context, params)
+
+    def fetch(self, context, params):
+        return context.coinGecko.market_data(params['coin'])
+
+    def format(self, context, params, response):
+        if response is None:
+            return not_found(context, params['name'])
+
+        data = response.market_cap
+        output = 'The current *' + params['coin'] + '* market cap is:\n'
+
+        # Build the response
+        for currency in data:
+            if currency in sign_map:
+                output = output + \
+                    emoji_map[currency] + ' ' + \
+                    formatNumber(data[currency]) + ' ' + \
+                    sign_map[currency] + \
+                    '\n'
+        return Text(output, markdown=True)
+
+
+# ========================= SUPPLY ========================= #
+class SupplyCommand(MarketCapCommand):
+
+    name = '!supply'
+
+    def format(self, context, params, response):
+        if response is None:
+            return not_found(context, params['name'])
+
+        coin = params['coin']
+        circulating = response.circulating_supply
+        output = 'Currently, there are ' + \
+                 formatNumber(circulating) + ' *' + coin + '*.'
+        total = response.total_supply
+
+        # Additional info if the crypto has finite supply
+        if total is not None:
+            percentage = (circulating/total)*100
+            output = output + ' The supply stops at ' + \
+                formatNumber(total) + ' *' + coin + '*.'
+            output = output + ' That means ' + \
+                formatNumber(percentage) + '% of *' + coin + \
+                '* has been issued.'
+        return Text(output, markdown=True)
+
+
+# ======================= INFORMATION ====================== #
+class InfoCommand(MarketCapCommand):
+
+    name = '!info'
+    upstream = 'Coin info'
+
+    def fetch(self, context, params):
+        return context.coinGecko.coin_info(params['coin'])
+
+    def format(self, context, params, response):
+        if response is None:
+            return not_found(context, params['name'])
+
+        output = '*' + response.name + \
+            ' (' + response.symbol + ')*\n\n'
+
+        twitter_url = response.twitter
+        if len(twitter_url) > 0:
+            twitter_url = 'https://twitter.com/' + twitter_url
+
+        facebook_url = response.facebook
+        if len(facebook_url) > 0:
+            facebook_url = 'https://www.facebook.com/' + facebook_url
+
+        telegram_channel = response.telegram
+        if len(telegram_channel) > 0:
+            telegram_channel = '@' + telegram_channel
+
+        output = output + \
+            'Webpage: ' + response.homepage + '\n' + \
+            'Twitter: ' + twitter_url + '\n' + \
+            'Facebook: ' + facebook_url + '\n' + \
+            'Telegram: ' + telegram_channel + '\n' + \
+            'Subreddit: ' + response.subreddit + '\n\n'
+
+        if response.genesis_date is not None:
+            inverted_date = response.genesis_date
+            correct_date = datetime.datetime \
+                .strptime(inverted_date, '%Y-%m-%d') \
+                .strftime('%d/%m/%Y')
+            output = output + \
+                '- Genesis date: ' + correct_date + '\n'
+
+        output = output + \
+            '- CoinGecko rank: ' + \
+            str(response.rank) + '\n'
+
+        output = output + \
+            '- Block time: ' + \
+            str(response.block_time) + \
+            ' minutes\n'
+
+        return Text(output, markdown=True)
+
+
+# ========================= ALERTS ========================= #
+class AlertCommand(Command):
+
+    name = '!alert'
+    upstream = 'Simple price'
+
+    def parse(self, argument, message):
+        # "bitcoin > 70000 usd": the coin, the direction, the price and
+        # optionally the currency
+        for operator in ('>', '<'):
+            if operator in argument:
+                name, condition = argument.split(operator, 1)
+                break
+        else:
+            raise InvalidFormat()
+
+        condition = condition.split()
+        if len(name.strip()) == 0 or not 1 <= len(condition) <= 2:
+            raise InvalidFormat()
+        try:
+            threshold = float(condition[0])
+        except ValueError:
+            raise InvalidFormat()
+        if not 0 < threshold < float('inf'):
+            raise InvalidFormat()
+
+        currency = condition[1] if len(condition) == 2 else 'usd'
+        if currency not in sign_map:
+            raise InvalidFormat(Text("The currency must be chf, inr, eur, " +
+                                     "cad, aud, gbp or usd", ok=False))
+        return {'chat_id': message['chat']['id'],
+                'name': name.strip(),
+                'coin': '-'.join(name.split()),
+                'above': operator == '>',
+                'threshold': threshold,
+                'currency': currency}
+
+    def resolve(self, context, params):
+        if context.alerts is None:
+            raise InvalidFormat(Text('Alerts are not available', ok=False))
+        resolve_coin(context, params)
+
+    def fetch(self, context, params):
+        # The current price, which also tells if the coin exists
+        return context.coinGecko.simple_prices([params['coin']])
+
+    def format(self, context, params, response):
+        coin = params['coin']
+        currency = params['currency']
+        if currency not in response.get(coin, {}):
+            return not_found(context, params['name'])
+
+        # An alert that would fire right away isn't stored
+        price = response[coin][currency]
+        if price >= params['threshold'] if params['above'] else \
+                price <= params['threshold']:
+            return Text('*' + coin + '* is already ' +
+                        ('above ' if params['above'] else 'below ') +
+                        formatNumber(params['threshold']) + ' ' +
+                        sign_map[currency] + ': it is ' +
+                        formatNumber(price) + ' ' + sign_map[currency] +
+                        ' now', ok=False, markdown=True)
+
+        alert = context.alerts.add(params['chat_id'], coin, currency,
+                                   params['above'], params['threshold'])
+        if alert is None:
+            return Text("You can't have more than " +
+                        str(context.alerts.max_per_chat) + ' alerts. ' +
+                        'Delete some with !alert_delete', ok=False)
+        return Text('Alert ' + str(alert.id) + ' set: ' +
+                    describe_alert(alert) + '. It is ' +
+                    formatNumber(price) + ' ' + sign_map[currency] + ' now',
+                    markdown=True)
+
+
+class AlertsCommand(Command):
+
+    name = '!alerts'
+    needs_arguments = False
+
+    def parse(self, argument, message):
+        return {'chat_id': message['chat']['id']}
+
+    def format(self, context, params, data):
+        if context.alerts is None:
+            return Text('Alerts are not available', ok=False)
+        alerts = context.alerts.of_chat(params['chat_id'])
+        if len(alerts) == 0:
+            return Text('You have no alerts. Set one with !alert')
+        return Text('\n'.join(str(alert.id) + ' - ' + describe_alert(alert)
+                              for alert in alerts), markdown=True)
+
+
+class AlertDeleteCommand(Command):
+
+    name = '!alert_delete'
+
+    def parse(self, argument, message):
+        if not argument.strip().isdigit():
+            raise InvalidFormat()
+        return {'chat_id': message['chat']['id'],
+                'id': int(argument.strip())}
+
+    def format(self, context, params, data):
+        if context.alerts is None:
+            return Text('Alerts are not available', ok=False)
+        if not context.alerts.remove(params['chat_id'], params['id']):
+            return Text('There is no alert ' + str(params['id']), ok=False)
+        return Text('Alert ' + str(params['id']) + ' deleted')
+
+
+# ======================== WATCHLIST ======================= #
+class WatchCommand(Command):
+
+    name = '!watch'
+    upstream = 'Simple price'
+
+    def parse(self, argument, message):
+        # "add bitcoin cash 2" or "remove bitcoin cash". The amount, if
+        # any, is the last word
+        words = argument.split()
+        if len(words) < 2 or words[0] not in ('add', 'remove'):
+            raise InvalidFormat()
+
+        amount = None
+        if words[0] == 'add' and len(words) > 2:
+            try:
+                amount = float(words[-1])
+                words = words[:-1]
+            except ValueError:
+                pass
+            if amount is not None and not 0 <= amount < float('inf'):
+                raise InvalidFormat()
+        return {'chat_id': message['chat']['id'],
+                'action': words[0],
+                'name': ' '.join(words[1:]),
+                'coin': '-'.join(words[1:]),
+                'amount': amount}
+
+    def resolve(self, context, params):
+        if context.portfolios is None:
+            raise InvalidFormat(Text('Watchlists are not available',
+                                     ok=False))
+        if params['action'] == 'add':
+            resolve_coin(context, params)
+        elif has_index(context):
+            # Coins no longer listed can be removed too
+            params['coin'] = context.coins.resolve(params['name']) or \
+                params['coin']
+
+    def fetch(self, context, params):
+        # Coins are only added if they exist
+        if params['action'] == 'add':
+            return context.coinGecko.simple_prices([params['coin']])
+        return None
+
+    def format(self, context, params, response):
+        coin = params['coin']
+        if params['action'] == 'remove':
+            if not context.portfolios.remove(params['chat_id'], coin):
+                return Text('*' + coin + '* is not in your watchlist',
+                            markdown=True, ok=False)
+            return Text('*' + coin + '* removed from your watchlist',
+                        markdown=True)
+
+        if coin not in response:
+            return not_found(context, params['name'])
+        if not context.portfolios.add(params['chat_id'], coin,
+                                      params['amount']):
+            return Text("You can't watch more than " +
+                        str(context.portfolios.max_coins) + ' coins', ok=False)
+        output = '*' + coin + '* added to your watchlist'
+        if params['amount'] is not None:
+            output = output + ', holding ' + formatNumber(params['amount'])
+        return Text(output, markdown=True)
+
+
+class WatchlistCommand(Command):
+
+    name = '!watchlist'
+    upstream = 'Simple price'
+    needs_arguments = False
+
+    def parse(self, argument, message):
+        currency = argument.strip() or 'usd'
+        if currency not in sign_map:
+            raise InvalidFormat(Text("The currency must be chf, inr, eur, " +
+                                     "cad, aud, gbp or usd", ok=False))
+        return {'chat_id': message['chat']['id'], 'currency': currency}
+
+    def resolve(self, context, params):
+        if context.portfolios is None:
+            raise InvalidFormat(Text('Watchlists are not available',
+                                     ok=False))
+        params['holdings'] = context.portfolios.holdings(params['chat_id'])
+
+    def fetch(self, context, params):
+        # Every coin of the watchlist in a single request
+        if len(params['holdings']) == 0:
+            return {}
+        return context.coinGecko.simple_prices(list(params['holdings']))
+
+    def format(self, context, params, response):
+        if len(params['holdings']) == 0:
+            return Text('Your watchlist is empty. Add coins with ' +
+                        '`!watch add [coin]`', markdown=True)
+        currency = params['currency']
+        output = emoji_map[currency] + ' Your watchlist:\n'
+        for coin in params['holdings']:
+            output = output + '*' + coin + '*: ' + \
+                price_text(response, coin, currency) + '\n'
+        return Text(output, markdown=True)
+
+
+class PortfolioCommand(WatchlistCommand):
+
+    name = '!portfolio'
+
+    def format(self, context, params, response):
+        holdings = {coin: amount for coin, amount
+                    in params['holdings'].items() if amount > 0}
+        if len(holdings) == 0:
+            return Text("You don't hold any coin. Add them with " +
+                        '`!watch add [coin] [amount]`', markdown=True)
+
+        currency = params['currency']
+        sign = sign_map[currency]
+        total = 0
+        output = emoji_map[currency] + ' Your portfolio:\n'
+        for coin, amount in holdings.items():
+            price = response.get(coin, {}).get(currency)
+            if price is None:
+                output = output + '*' + coin + '*: ' + \
+                    formatNumber(amount) + ' (no price)\n'
+                continue
+            total += amount * price
+            output = output + '*' + coin + '*: ' + \
+                formatNumber(amount) + ' × ' + formatNumber(price) + ' ' + \
+                sign + ' = ' + formatNumber(round(amount * price, 2)) + \
+                ' ' + sign + '\n'
+        output = output + '\n*Total*: ' + formatNumber(round(total, 2)) + \
+            ' ' + sign
+        return Text(output, markdown=True)
+
+
+# Every command the bot understands
+registry = [StartCommand(), HelpCommand(), PriceCommand(),
+            EvolutionCommand(), EvolutionImageCommand(),
+            PriceChangeCommand(), TopCoinsCommand(), MarketCapCommand(),
+            SupplyCommand(), InfoCommand(), AlertCommand(), AlertsCommand(),
+            AlertDeleteCommand(), WatchCommand(), WatchlistCommand(),
+            PortfolioCommand()]
+
+
+def has_index(context):
+    return context.coins is not None and context.coins.ready()
+
+
+def resolve_coin(context, params):
+    # params['name'] can be the id, the symbol or the name of the coin
+    if not has_index(context):
+        return
+    coin = context.coins.resolve(params['name'])
+    if coin is None:
+        raise InvalidFormat(not_found(context, params['name']))
+    params['coin'] = coin
+
+
+def not_found(context, name):
+    # Suggest the coins the user might have meant
+    output = '*' + name + '* not found'
+    if has_index(context):
+        suggestions = context.coins.suggest(name)
+        if len(suggestions) > 0:
+            output = output + '. Did you mean ' + \
+                ', '.join('*' + coin + '*' for coin in suggestions) + '?'
+    return Text(output, markdown=True, ok=False)
+
+
+def price_text(prices, coin, currency):
+    price = prices.get(coin, {}).get(currency)
+    if price is None:
+        return 'no price'
+    return formatNumber(price) + ' ' + sign_map[currency]
+
+
+def describe_alert(alert):
+    return '*' + alert.coin + '* ' + \
+        ('above ' if alert.above else 'below ') + \
+        formatNumber(alert.threshold) + ' ' + sign_map[alert.currency]
+
+
+def alert_fired(alert, price):
+    # Notification of an alert whose price has been reached
+    return Text('🔔 ' + describe_alert(alert) + '. It is ' +
+                formatNumber(price) + ' ' + sign_map[alert.currency] +
+                ' now', markdown=True)
+
+
+def formatNumber(number):
+
+    # Add thousands separator
+    commaSeparator = "{:,}".format(number)
+
+    # Replace commas with dots and vice versa
+    num = commaSeparator.replace('.', '|').replace(',', '.').replace('|', ',')
+
+    # Check it has at least 2 decimal places
+    divide = num.split(',')
+    if len(divide) == 1:
+        num = num + ',00'  # No decimals, add 2
+    if len(divide) == 2 and len(divide[1]) == 1:
+        num = num + '0'  # Only 1 decimal, add 1
+
+    return num
@@ -0,0 +1,117 @@
+import collections
+import concurrent.futures
+import logging
+import threading
+
+
+def update_chat(update):
+    # Chat where the update comes from (None if it doesn't belong to any chat)
+    for kind in ('message', 'edited_message'):
+        if kind in update:
+            return update[kind]['chat']['id']
+    return None
+
+
+class Dispatcher:
+
+    def __init__(self, handler, max_workers=8, max_pending=64,
+                 ordered=True):
+        self.handler = handler
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+
+        # Blocks the producer when too many updates are waiting or running
+        self.slots = threading.BoundedSemaphore(max_pending)
+
+        self.lock = threading.Lock()
+        self.chats = {}  # Chat -> updates of that chat still to be handled
+        self.pending = set()  # Identifiers of the updates not handled yet
+        self.last_update = None  # Highest identifier ever submitted
+
+        # Long polling gets the updates in order, so any identifier not above
+        # the last one was already submitted. Webhooks can deliver them in
+        # any order, so the recent identifiers are remembered instead
+        self.ordered = ordered
+        self.recent = collections.deque(maxlen=4096)
+        self.recent_set = set()
+
+    def submit(self, update):
+        # Returns False if the update had already been submitted
+        update_id = update['update_id']
+        with self.lock:
+            if self._seen(update_id):
+                return False
+
+        self.slots.acquire()
+
+        # Updates without chat don't need any order, so use their own queue
+        chat_id = update_chat(update)
+        if chat_id is not None:
+            key = ('chat', chat_id)
+        else:
+            key = ('update', update_id)
+
+        with self.lock:
+            if not self.ordered:
+                if self._seen(update_id):  # Submitted in the meantime
+                    self.slots.release()
+                    return False
+                if len(self.recent) == self.recent.maxlen:
+                    self.recent_set.discard(self.recent[0])
+                self.recent.append(update_id)
+                self.recent_set.add(update_id)
+            if self.last_update is None or update_id > self.last_update:
+                self.last_update = update_id
+            self.pending.add(update_id)
+            queue = self.chats.get(key)
+            if queue is None:
+                self.chats[key] = collections.deque([update])
+                self.executor.submit(self._run_chat, key)
+            else:
+                queue.append(update)
+        return True
+
+    def _seen(self, update_id):
+        if not self.ordered:
+            return update_id in self.recent_set
+        return self.last_update is not None and update_id <= self.last_update
+
+    def _run_chat(self, key):
+        # Handle the updates of a single chat one after another
+        while True:
+            with self.lock:
+                queue = self.chats[key]
+                if len(queue) == 0:
+                    del self.chats[key]
+                    return
+
+                # Keep it in the queue while running, so new updates of the
+                # same chat wait for it instead of starting another worker
+                update = queue[0]
+
+            try:
+                self.handler(update)
+            except Exception:
+                logging.exception('Update failed',
+                                  extra={'update': update['update_id']})
+            finally:
+                with self.lock:
+                    queue.popleft()
+                    self.pending.discard(update['update_id'])
+                self.slots.release()
+
+    def offset(self):
+        # First update that hasn't been handled yet. Every update below it is
+        # finished, so it's safe to confirm them to Telegram
+        with self.lock:
+            if len(self.pending) > 0:
+                return min(self.pending)
+            if self.last_update is None:
+                return None
+            return self.last_update + 1
+
+    def pending_count(self):
+        with self.lock:
+            return len(self.pending)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait)
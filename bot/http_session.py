@@ -0,0 +1,43 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def create_session(pool_size=10, retries=3, backoff=0.5,
+                   retry_statuses=(500, 502, 503, 504)):
+    # Session keeping connections alive, so the TCP and TLS handshakes are
+    # only done once per connection of the pool
+    session = requests.Session()
+
+    # Connection errors and retry_statuses answers are retried, waiting
+    # backoff * 2^(retry - 1) seconds between attempts. Only idempotent
+    # methods are retried when the request was already sent
+    retry = Retry(total=retries,
+                  backoff_factor=backoff,
+                  status_forcelist=retry_statuses,
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size,
+                          max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def connection_stats(session):
+    # Requests sent through the session and connections opened for them
+    connections = 0
+    sent = 0
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            try:
+                pool = pools[key]
+            except KeyError:
+                continue  # Closed in the meantime
+            connections += pool.num_connections
+            sent += pool.num_requests
+
+    return {'connections': connections,
+            'requests': sent,
+            'reused': max(sent - connections, 0)}
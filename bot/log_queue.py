@@ -0,0 +1,84 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import random
+
+# Fields the records can carry (logging.debug(..., extra={'chat': 1})),
+# written after the message as name=value
+fields = ('command', 'chat', 'outcome', 'ms', 'update', 'status')
+
+_listener = None  # Thread writing the records
+
+
+class StructuredFormatter(logging.Formatter):
+
+    def formatMessage(self, record):
+        text = super().formatMessage(record)
+        values = [name + '=' + str(getattr(record, name)) for name in fields
+                  if hasattr(record, name)]
+        if len(values) > 0:
+            text = text + ' [' + ' '.join(values) + ']'
+        return text
+
+
+class Sampler(logging.Filter):
+
+    def __init__(self, rates):
+        # Level (name or number) -> fraction of its records kept. Levels
+        # not given keep every record
+        super().__init__()
+        self.rates = {}
+        for level, rate in rates.items():
+            if isinstance(level, str):
+                level = logging.getLevelName(level.upper())
+            self.rates[level] = rate
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno)
+        return rate is None or random.random() < rate
+
+
+def start(path='bot.log', level=logging.INFO, max_bytes=10 * 1024 * 1024,
+          backups=5, sampling=None):
+    # The threads logging only put the records in a queue. A thread of its
+    # own writes them to path, so writing to disk never delays a reply. The
+    # file is rotated when it reaches max_bytes, keeping backups old ones.
+    # Records dropped by sampling (level -> fraction kept) cost nothing else
+    writer = logging.handlers.RotatingFileHandler(
+        path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8'
+    )
+    writer.setFormatter(logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    ))
+
+    # The message is completed with its fields (and the traceback, if any)
+    # before it's queued
+    records = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(records)
+    handler.setFormatter(StructuredFormatter('%(message)s'))
+    if sampling:
+        handler.addFilter(Sampler(sampling))
+    listener = logging.handlers.QueueListener(records, writer)
+
+    root = logging.getLogger()
+    for previous in list(root.handlers):
+        root.removeHandler(previous)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    global _listener
+    stop()
+    _listener = listener
+    listener.start()
+
+
+def stop():
+    # Writes whatever is still in the queue. Runs at exit too
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop)
@@ -1,609 +1,314 @@
-import datetime
-import time
+import os
+import signal
+import sys
+import urllib.parse
+import alerts
 import config
 import telegram_api
 import coingecko_api
-import matplotlib.pyplot as plt
+import dispatcher
+import prefetcher
+import poller
+import portfolio
+import price_store
+import rate_limit
+import charts
+import coin_index
+import commands
+import log_queue
+import render_pool
+import router
+import send_queue
+import sharding
+import snapshot
+import webhook
+import metrics
 import logging
 
 
-def main():
-    bot = telegram_api.TelegramRequester(config.bot_token)
-    current_offset = None  # Identifier of the first update to be returned
-    coinGecko = coingecko_api.CoinGeckoRequester()
-
+def start_logging(path='bot.log'):
     # DEBUG: Bot interactions (send, receive messages) and connections
     # INFO: Bot starts/stops and configuration changes
     # WARNING: Connection error
-    logLevel = logging.INFO
-    logging.basicConfig(
-        filename='bot.log',
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        level=logLevel
+    # Records are written by a thread of their own, so even DEBUG doesn't
+    # slow down the replies. Verbose levels can be sampled
+    logLevel = getattr(config, 'log_level', logging.INFO)
+    log_queue.start(
+        path,
+        level=logLevel,
+        max_bytes=10 * 1024 * 1024,
+        backups=5,
+        sampling=getattr(config, 'log_sampling', None)
+    )
+
+
+def start_coin_index(coinGecko, download=True):
+    # Coins are looked up by id, symbol or name in a local copy of the list
+    # of coins, downloaded once a day
+    coins = coin_index.CoinIndex('coins.json')
+    coin_index.Refresher(coins, coinGecko, download=download).start()
+    metrics.registry.gauge('bot_coin_index', 'Coins that can be looked up',
+                           coins.stats)
+    return coins
+
+
+def build_router(bot, coinGecko, coins, processes, shards=1,
+                 alerts_path='alerts.db', portfolio_path='portfolio.db'):
+    # Charts are drawn in other processes, so they don't compete for the GIL
+    # with the threads answering the rest of the commands. The workers load
+    # matplotlib in the background as soon as they start
+    renderer = render_pool.RenderPool(
+        processes=processes,
+        max_jobs=16,
+        timeout=30,
+        jobs_per_worker=50,
+        initializer=charts.warm
+    )
+
+    # Charts already drawn (and uploaded) recently
+    chart_cache = charts.ImageCache(max_bytes=32 * 1024 * 1024)
+
+    # Replies are queued and sent within the flood limits of Telegram, which
+    # every shard shares
+    sender = send_queue.SendQueue(
+        bot,
+        workers=4,
+        global_rate=30 / shards,
+        chat_rate=1,
+        max_pending=1000
     )
+
+    metrics.registry.gauge('bot_send_queue', 'Messages waiting to be sent',
+                           sender.stats)
+    metrics.registry.gauge('bot_chart_cache', 'Charts drawn recently',
+                           chart_cache.stats)
+    metrics.registry.gauge('bot_render_pool', 'Charts rendered',
+                           renderer.stats)
+
+    # Price alerts are checked every minute, all their coins at once
+    alert_store = alerts.AlertStore(alerts_path)
+
+    # Watchlists and holdings of every chat
+    portfolios = portfolio.PortfolioStore(portfolio_path)
+    metrics.registry.gauge('bot_portfolios', 'Coins watched by the chats',
+                           portfolios.stats)
+
+    context = commands.Context(sender, coinGecko, renderer, chart_cache, coins,
+                               alert_store, portfolios)
+    alerts.AlertEngine(
+        alert_store,
+        coinGecko,
+        lambda alert, price: commands.alert_fired(alert, price).send(
+            context, alert.chat_id
+        ),
+        interval=60
+    ).start()
+    metrics.registry.gauge('bot_alerts', 'Price alerts waiting',
+                           alert_store.stats)
+
+    # Every command is looked up in a table of handlers
+    return router.Router(context)
+
+
+def start_metrics(bot, coinGecko, port):
+    # Summaries of the metrics go to the log every minute. With a port, they
+    # are also served in the Prometheus format
+    metrics.registry.gauge('bot_coingecko_cache', 'CoinGecko answers cached',
+                           coinGecko.cache_stats)
+    metrics.registry.gauge('bot_coingecko_scheduler',
+                           'CoinGecko requests waiting for the rate limit',
+                           coinGecko.scheduler_stats)
+    metrics.registry.gauge('bot_coingecko_flights',
+                           'CoinGecko requests shared by several callers',
+                           coinGecko.flight_stats)
+    metrics.registry.gauge('bot_coingecko_batches',
+                           'Coins asked together for their prices',
+                           coinGecko.batch_stats)
+    metrics.registry.gauge('bot_coingecko_connections',
+                           'Connections to CoinGecko and their reuse',
+                           coinGecko.connection_stats)
+    metrics.registry.gauge('bot_telegram_connections',
+                           'Connections to Telegram and their reuse',
+                           bot.connection_stats)
+    metrics.Reporter(interval=60).start()
+    if port is not None:
+        metrics.MetricsServer(port=port).start()
+
+
+def start_shard(shard, shards, cache, popular):
+    # Runs in every worker process of the sharded mode. The CoinGecko rate
+    # limit is split among the workers and the prefetcher, charts are
+    # rendered in the worker itself and every worker keeps its own price
+    # store, as the stores can't be shared between processes. Every worker
+    # writes (and rotates) its own log
+    start_logging('bot-shard-' + str(shard) + '.log')
+    logging.info('Shard ' + str(shard) + ' starts')
+    startup = metrics.Startup('Shard ' + str(shard))
+    bot = telegram_api.TelegramRequester(config.bot_token)
+    coinGecko = coingecko_api.CoinGeckoRequester(
+        store=price_store.PriceStore(
+            os.path.join('prices', 'shard-' + str(shard))
+        ),
+        scheduler=rate_limit.Scheduler(rate_per_minute=30 / (shards + 1),
+                                       burst=2),
+        cache=sharding.SharedCache(cache),
+        popular=popular
+    )
+    with startup.phase('coin index'):
+        coins = start_coin_index(coinGecko, download=False)
+
+    # Every worker serves its metrics on the next ports
+    port = getattr(config, 'metrics_port', None)
+    start_metrics(bot, coinGecko, None if port is None else port + 1 + shard)
+
+    # The alerts and the watchlist of a chat are always in the databases of
+    # its shard
+    with startup.phase('handlers'):
+        commandRouter = build_router(bot, coinGecko, coins, processes=0,
+                                     shards=shards,
+                                     alerts_path='alerts-shard-' +
+                                     str(shard) + '.db',
+                                     portfolio_path='portfolio-shard-' +
+                                     str(shard) + '.db')
+    startup.report()
+    return commandRouter.handle
+
+
+def main():
+    bot = telegram_api.TelegramRequester(config.bot_token)
+    start_logging()
     logging.info('Bot starts')
+    startup = metrics.Startup()
+
+    # With a webhook, Telegram posts the updates as soon as they arrive,
+    # several at a time, so they can come in any order
+    webhook_url = getattr(config, 'webhook_url', None)
+
+    # With several shards, updates are handled by that many processes. The
+    # updates of a chat always go to the same one
+    shards = getattr(config, 'shards', 1)
+    chart_cache = None
+    if shards > 1:
+        with startup.phase('shards'):
+            updates = sharding.ShardRouter(
+                start_shard,
+                shards=shards,
+                ordered=webhook_url is None
+            )
+            coinGecko = coingecko_api.CoinGeckoRequester(
+                scheduler=rate_limit.Scheduler(
+                    rate_per_minute=30 / (shards + 1), burst=2
+                ),
+                cache=sharding.SharedCache(updates.cache),
+                popular=updates.popular
+            )
+            metrics.registry.gauge('bot_shards', 'Workers handling updates',
+                                   updates.stats)
+        with startup.phase('coin index'):
+            start_coin_index(coinGecko)
+    else:
+        coinGecko = coingecko_api.CoinGeckoRequester(
+            store=price_store.PriceStore('prices'),
+            scheduler=rate_limit.Scheduler(rate_per_minute=30, burst=5)
+        )
+        with startup.phase('coin index'):
+            coins = start_coin_index(coinGecko)
+
+        # Updates run on a pool of workers, keeping the order inside each
+        # chat
+        with startup.phase('handlers'):
+            commandRouter = build_router(bot, coinGecko, coins,
+                                         processes=os.cpu_count())
+            chart_cache = commandRouter.context.chart_cache
+            updates = dispatcher.Dispatcher(
+                commandRouter.handle,
+                max_workers=8,
+                max_pending=64,
+                ordered=webhook_url is None
+            )
+
+    # Long polling (30 seconds by default) in its own thread, so the next
+    # updates are received while the previous ones are handled
+    updatePoller = None
+    if webhook_url is None:
+        updatePoller = poller.Poller(
+            bot,
+            updates,
+            journal=poller.UpdateJournal('updates.journal'),
+            limit=100,
+            allowed_updates=['message']
+        )
+        metrics.registry.gauge('bot_poller', 'Updates received from Telegram',
+                               updatePoller.stats)
+
+    # What the last run had cached, so the first commands are answered
+    # without asking upstream again
+    saver = snapshot.Snapshot('snapshot.pickle', interval=5 * 60)
+    saver.add('cache', coinGecko.cache.dump, coinGecko.cache.restore)
+    saver.add('popular', coinGecko.dump_popular, coinGecko.restore_popular)
+    if chart_cache is not None:
+        saver.add('charts', chart_cache.dump, chart_cache.restore)
+    if updatePoller is not None:
+        saver.add('offset', lambda: updatePoller.offset, updatePoller.resume)
+    with startup.phase('snapshot'):
+        saver.load()
+
+    with startup.phase('background'):
+        metrics.registry.gauge('bot_updates_pending',
+                               'Updates not handled yet',
+                               updates.pending_count)
+        start_metrics(bot, coinGecko, getattr(config, 'metrics_port', None))
+
+        # The prices of the most asked coins are always kept in the cache
+        prices = prefetcher.Prefetcher(
+            coinGecko,
+            fixed=['bitcoin', 'ethereum'],
+            top=20,
+            popular=10,
+            interval=20,
+            budget=10
+        )
+        prices.start()
+        saver.start()
 
-    # Equivalence between currencies and emojis
-    emoji_map = {'chf': '🇨🇭', 'inr': '🇮🇳', 'eur': '🇪🇺', 'cad': '🇨🇦',
-                 'aud': '🇦🇺', 'gbp': '🇬🇧', 'usd': '🇺🇸'}
-    # Equivalence between currencies and signs
-    sign_map = {'chf': 'CHF', 'inr': '₹', 'eur': '€', 'cad': '$',
-                'aud': '$', 'gbp': '£', 'usd': '$'}
-
-    # Infinite loop doing long polling (30 seconds by default)
-    while True:
-        unread_messages = bot.get_updates(current_offset)
-
-        for message in unread_messages:
-            update_id = message['update_id']
-
-            # If the user edits a previous message, ignore it
-            if 'message' not in message:
-                chat_id = message['edited_message']['chat']['id']
-                logging.debug('Ignored edited message ' +
-                              '[Chat: ' + str(chat_id) + ']')
-                current_offset = update_id + 1
-                continue
-
-            chat_id = message['message']['chat']['id']
-
-            # Check if it's a text message
-            if 'text' in message['message']:
-                received_text = message['message']['text']
-            else:
-                logging.debug('Ignored non-text message ' +
-                              '[Chat: ' + str(chat_id) + ']')
-                current_offset = update_id + 1
-                continue
-
-            # arguments[0] -> command
-            # arguments[1] -> actual arguments
-            arguments = received_text.lower().strip().split(" ", 1)
-
-            # ======================= BASIC COMMANDS ======================= #
-            if arguments[0] == '/start':
-                output = "Hey " + message['message']['chat']['first_name'] + \
-                    "! I'm here to help you manage cryptocurrency " + \
-                    "information. Use /help to find out more about how to " + \
-                    "interact with me"
-                bot.send_message(chat_id, output)
-                logging.debug('OK /start ' +
-                              '[Chat: ' + str(chat_id) + ']')
-
-            elif arguments[0] == '/help':
-                output = "You can control me by sending these commands\n\n" + \
-                    "*!price [coin]* - Current price of the " + \
-                    "cryptocurrency. " + \
-                    "For example: `!price bitcoin`\n\n" + \
-                    "*!info [coin]* - Basic information about the " + \
-                    "cryptocurrency. " + \
-                    "For example: `!info bitcoin`\n\n" + \
-                    "*!price_change [interval] [coin]* - Price change " + \
-                    "percentage of the cryptocurrency within an interval. " + \
-                    "The interval must be 1h, 24h, 7d, 24d, 30d, 60d, " + \
-                    "200d or 1y. " + \
-                    "For example: `!price_change 7d bitcoin`\n\n" + \
-                    "*!evolution [days] [currency] [coin]* - Price " + \
-                    "evolution of a coin converted into a currency. " + \
-                    "The currency must be chf, inr, eur, cad, aud, gbp " + \
-                    "or usd. " + \
-                    "For example: `!evolution 15 usd bitcoin`\n\n" + \
-                    "*!top_coins [currency]* - Image showing the price " + \
-                    "change of the top 10 cryptocurrencies in the last 24 " + \
-                    "hours. The currency must be chf, inr, eur, cad, aud, " + \
-                    "gbp or usd. " + \
-                    "For example: `!top_coins usd`\n\n" + \
-                    "*!evolution_img [days] [currency] [coin]* - Image " + \
-                    "showing the price evolution of a coin converted into " + \
-                    "a currency. The currency must be chf, inr, eur, cad, " + \
-                    "aud, gbp or usd. " + \
-                    "For example: `!evolution_img 365 usd bitcoin`\n\n" + \
-                    "*!market_cap [coin]* - Market capitalization of the " + \
-                    "cryptocurrency. " + \
-                    "For example: `!market_cap bitcoin`\n\n" + \
-                    "*!supply [coin]* - Current supply for the " + \
-                    "cryptocurrency. " + \
-                    "For example: `!supply bitcoin`"
-                bot.send_markdown_message(chat_id, output)
-                logging.debug('OK /help ' +
-                              '[Chat: ' + str(chat_id) + ']')
-
-            # ===================== ADVANCED COMMANDS ====================== #
-            if len(arguments) == 2:
-
-                # ====================== SIMPLE PRICE ====================== #
-                if arguments[0] == '!price':
-
-                    # Convert spaces in the name of the coin into hyphens
-                    coin = arguments[1].strip().replace(' ', '-')
-
-                    try:
-                        response = coinGecko.simple_price(coin)
-                    except:
-                        logging.warning('CoinGecko API failed [Simple price]')
-                        output = 'The service is unavailable, try again later'
-                        bot.send_message(chat_id, output)
-
-                        # Update the offset
-                        current_offset = update_id + 1
-                        continue
-
-                    if len(response) > 0:
-                        output = 'The current *' + coin + '* price is:\n'
-
-                        # Build the response
-                        for currency in response:
-                            output = output + \
-                                emoji_map[currency] + ' ' + \
-                                formatNumber(response[currency]) + ' ' + \
-                                sign_map[currency] + \
-                                '\n'
-                        logging.debug('OK !price ' +
-                                      '[Chat: ' + str(chat_id) + ']')
-                    else:
-                        output = '*' + arguments[1] + '* not found'
-                        logging.debug('BAD !price ' +
-                                      '[Chat: ' + str(chat_id) + ']')
-
-                    bot.send_markdown_message(chat_id, output)
-
-                # ====================== MARKET CHART ====================== #
-                elif arguments[0] == '!evolution':
-
-                    # evolution_args[0] -> days
-                    # evolution_args[1] -> currency
-                    # evolution_args[2] -> coin
-                    evolution_args = arguments[1].strip().split(" ", 2)
-
-                    if len(evolution_args) == 3:
-                        days = evolution_args[0]
-                        currency = evolution_args[1]
-                        coin = evolution_args[2].strip().replace(' ', '-')
-
-                        if currency in sign_map:
-
-                            try:
-                                response = coinGecko.market_chart(
-                                    coin, currency, days
-                                )
-                            except:
-                                logging.warning('CoinGecko API failed ' +
-                                                '[Market chart]')
-                                output = 'The service is unavailable, ' + \
-                                    'try again later'
-                                bot.send_message(chat_id, output)
-
-                                # Update the offset
-                                current_offset = update_id + 1
-                                continue
-                        else:
-                            response = []
-
-                        if len(response) > 0:
-
-                            # Return only 12 values
-                            cut_point = int(len(response)/11)
-                            response = response[0::cut_point]
-
-                            # Build the response
-                            output = 'Evolution of *' + \
-                                     evolution_args[2].strip() + \
-                                     '* in the last ' + days + ' day(s)' +\
-                                     ' ' + emoji_map[currency] + '\n\n'
-                            for index, price in enumerate(response):
-
-                                # Convert the time deleting milliseconds
-                                timestamp = str(price[0])[0: 10]
-                                date = datetime.datetime \
-                                    .fromtimestamp(float(timestamp)) \
-                                    .strftime('%d/%m/%Y -- %H:%M')
-
-                                # Check if the price has increased or not
-                                if index > 0:
-                                    previous = response[index-1][1]
-                                    current = response[index][1]
-                                    if previous > current:
-                                        tendency = '⬇️'
-                                    elif previous < current:
-                                        tendency = '⬆️'
-                                    else:
-                                        tendency = '➡️'
-                                else:
-                                    tendency = '⏹️'
-
-                                # Get all together
-                                output = output + \
-                                    '_' + str(date) + '_\n' + \
-                                    tendency + ' ' + \
-                                    formatNumber(price[1]) + ' ' + \
-                                    sign_map[currency] + '\n\n'
-
-                            bot.send_markdown_message(chat_id, output)
-                            logging.debug('OK !evolution ' +
-                                          '[Chat: ' + str(chat_id) + ']')
-                        else:
-                            output = 'Invalid format'
-                            bot.send_message(chat_id, output)
-                            logging.debug('BAD !evolution ' +
-                                          '[Chat: ' + str(chat_id) + ']')
-                    else:
-                        output = 'Invalid format'
-                        bot.send_message(chat_id, output)
-                        logging.debug('BAD !evolution ' +
-                                      '[Chat: ' + str(chat_id) + ']')
-
-                # ================ MARKET CHART WITH IMAGE ================= #
-                elif arguments[0] == '!evolution_img':
-
-                    # evolution_args[0] -> days
-                    # evolution_args[1] -> currency
-                    # evolution_args[2] -> coin
-                    evolution_args = arguments[1].strip().split(" ", 2)
-
-                    if len(evolution_args) == 3:
-                        days = evolution_args[0]
-                        currency = evolution_args[1]
-                        coin = evolution_args[2].strip().replace(' ', '-')
-
-                        if currency in sign_map:
-
-                            try:
-                                response = coinGecko.market_chart(
-                                    coin, currency, days
-                                )
-                            except:
-                                logging.warning('CoinGecko API failed ' +
-                                                '[Market chart]')
-                                output = 'The service is unavailable, ' + \
-                                    'try again later'
-                                bot.send_message(chat_id, output)
-
-                                # Update the offset
-                                current_offset = update_id + 1
-                                continue
-                        else:
-                            response = []
-
-                        if len(response) > 0:
-                            x = []
-                            y = []
-
-                            for point in response:
-
-                                # Convert the time deleting milliseconds
-                                timestamp = str(point[0])[0: 10]
-                                date = datetime.datetime \
-                                    .fromtimestamp(float(timestamp))
-
-                                # Add values to x-axis and y-axis
-                                x.append(date)
-                                y.append(point[1])
-
-                            plt.plot(x, y)
-                            title = 'Evolution of ' + \
-                                    evolution_args[2].strip() + \
-                                    ' in the last ' + days + ' day(s)'
-                            plt.title(title)
-                            plt.ylabel(currency)  # y-axis showing currency
-                            plt.xticks(rotation=90)  # Fit values in x-axis
-                            plt.tight_layout()  # Give enough room to the graph
-                            plt.savefig('graph.png')  # Save file to send
-                            photo = open('graph.png', 'rb')  # Open file saved
-                            bot.send_photo(chat_id, photo)
-                            logging.debug('OK !evolution_img ' +
-                                          '[Chat: ' + str(chat_id) + ']')
-                            photo.close()  # Free resources
-                            plt.clf()  # Clear graph
-                        else:
-                            output = 'Invalid format'
-                            bot.send_message(chat_id, output)
-                            logging.debug('BAD !evolution_img ' +
-                                          '[Chat: ' + str(chat_id) + ']')
-                    else:
-                        output = 'Invalid format'
-                        bot.send_message(chat_id, output)
-                        logging.debug('BAD !evolution_img ' +
-                                      '[Chat: ' + str(chat_id) + ']')
-
-                # ====================== PRICE CHANGE ====================== #
-                elif arguments[0] == '!price_change':
-
-                    # price_change[0] -> interval
-                    # price_change[1] -> coin
-                    price_change = arguments[1].strip().split(" ", 1)
-
-                    if len(price_change) == 2:
-                        interval = price_change[0]
-                        allowed_interval = {'1h', '24h', '7d', '14d',
-                                            '30d', '60d', '200d', '1y'}
-                        coin = price_change[1].strip().replace(' ', '-')
-                        if interval in allowed_interval:
-
-                            try:
-                                response = coinGecko.market_data(coin)
-                            except:
-                                logging.warning('CoinGecko API failed ' +
-                                                '[Market data]')
-                                output = 'The service is unavailable, ' + \
-                                    'try again later'
-                                bot.send_message(chat_id, output)
-
-                                # Update the offset
-                                current_offset = update_id + 1
-                                continue
-
-                            if len(response) > 0:
-                                data = response['price_change_percentage_' +
-                                                interval +
-                                                '_in_currency']
-                                output = 'Price change of *' + coin + \
-                                         '* in the last _' + interval + '_:\n'
-
-                                # Build the response
-                                for currency in data:
-                                    if currency in sign_map:
-                                        value = formatNumber(data[currency]) +\
-                                            '%'
-                                        if data[currency] > 0:
-                                            value = '+' + value
-                                        output = output + \
-                                            emoji_map[currency] + ' ' + \
-                                            value + ' ' + \
-                                            sign_map[currency] + \
-                                            '\n'
-                                logging.debug('OK !price_change ' +
-                                              '[Chat: ' + str(chat_id) + ']')
-                            else:
-                                output = '*' + coin + '* not found'
-                                logging.debug('BAD !price_change ' +
-                                              '[Chat: ' + str(chat_id) + ']')
-                        else:
-                            output = 'Interval must be ' + \
-                                    '`1h`, `24h`, `7d`, `24d`, `30d`, ' + \
-                                    '`60d`, `200d` or `1y`'
-                            logging.debug('BAD !price_change ' +
-                                          '[Chat: ' + str(chat_id) + ']')
-
-                        bot.send_markdown_message(chat_id, output)
-                    else:
-                        output = 'Invalid format'
-                        bot.send_message(chat_id, output)
-                        logging.debug('BAD !price_change ' +
-                                      '[Chat: ' + str(chat_id) + ']')
-
-                # =========== 24H TOP CRYPTOCURRENCIES WITH IMAGE ========== #
-                elif arguments[0] == '!top_coins':
-                    currency = arguments[1]
-
-                    if currency in sign_map:
-                        try:
-                            response = coinGecko.coins_markets(currency, 10)
-                        except:
-                            logging.warning('CoinGecko API failed [Top coins]')
-                            output = 'The service is unavailable, ' + \
-                                'try again later'
-                            bot.send_message(chat_id, output)
-
-                            # Update the offset
-                            current_offset = update_id + 1
-                            continue
-
-                        x = []
-                        y = []
-                        colors = []
-
-                        for crypto in response:
-                            x.append(crypto['name'])
-                            change = crypto['price_change_percentage_24h']
-                            y.append(change)
-                            if change < 0:
-                                colors.append('r')  # Red color
-                            else:
-                                colors.append('g')  # Green color
-
-                        plt.bar(x, y, color=colors)
-                        plt.title('24 hours price change of the' +
-                                  ' top 10 cryptocurrencies')
-                        plt.ylabel('% in ' + currency)
-                        plt.xticks(rotation=90)  # Fit long names in x-axis
-                        plt.tight_layout()  # Give enough room to the graph
-                        plt.savefig('graph.png')  # Save file to send
-                        photo = open('graph.png', 'rb')  # Open file saved
-                        bot.send_photo(chat_id, photo)
-                        logging.debug('OK !top_coins ' +
-                                      '[Chat: ' + str(chat_id) + ']')
-                        photo.close()  # Free resources
-                        plt.clf()  # Clear graph
-                    else:
-                        output = "The currency must be chf, inr, eur, " + \
-                            "cad, aud, gbp or usd"
-                        bot.send_message(chat_id, output)
-                        logging.debug('BAD !top_coins ' +
-                                      '[Chat: ' + str(chat_id) + ']')
-
-                # ======================= MARKET CAP ======================= #
-                elif arguments[0] == '!market_cap':
-
-                    # Convert spaces in the name of the coin into hyphens
-                    coin = arguments[1].strip().replace(' ', '-')
-
-                    try:
-                        response = coinGecko.market_data(coin)
-                    except:
-                        logging.warning('CoinGecko API failed ' +
-                                        '[Market data]')
-                        output = 'The service is unavailable, try again later'
-                        bot.send_message(chat_id, output)
-
-                        # Update the offset
-                        current_offset = update_id + 1
-                        continue
-
-                    if len(response) > 0:
-                        data = response['market_cap']
-                        output = 'The current *' + coin + '* market cap is:\n'
-
-                        # Build the response
-                        for currency in data:
-                            if currency in sign_map:
-                                output = output + \
-                                    emoji_map[currency] + ' ' + \
-                                    formatNumber(data[currency]) + ' ' + \
-                                    sign_map[currency] + \
-                                    '\n'
-                        logging.debug('OK !market_cap ' +
-                                      '[Chat: ' + str(chat_id) + ']')
-                    else:
-                        output = '*' + arguments[1] + '* not found'
-                        logging.debug('BAD !market_cap ' +
-                                      '[Chat: ' + str(chat_id) + ']')
-
-                    bot.send_markdown_message(chat_id, output)
-
-                # ========================= SUPPLY ========================= #
-                elif arguments[0] == '!supply':
-
-                    # Convert spaces in the name of the coin into hyphens
-                    coin = arguments[1].strip().replace(' ', '-')
-
-                    try:
-                        response = coinGecko.market_data(coin)
-                    except:
-                        logging.warning('CoinGecko API failed ' +
-                                        '[Market data]')
-                        output = 'The service is unavailable, try again later'
-                        bot.send_message(chat_id, output)
-
-                        # Update the offset
-                        current_offset = update_id + 1
-                        continue
-
-                    if len(response) > 0:
-                        circulating = response['circulating_supply']
-                        output = 'Currently, there are ' + \
-                                 formatNumber(circulating) + ' *' + coin + '*.'
-                        total = response['total_supply']
-
-                        # Additional info if the crypto has finite supply
-                        if total is not None:
-                            percentage = (circulating/total)*100
-                            output = output + ' The supply stops at ' + \
-                                formatNumber(total) + ' *' + coin + '*.'
-                            output = output + ' That means ' + \
-                                formatNumber(percentage) + '% of *' + coin + \
-                                '* has been issued.'
-                        logging.debug('OK !supply ' +
-                                      '[Chat: ' + str(chat_id) + ']')
-                    else:
-                        output = '*' + arguments[1] + '* not found'
-                        logging.debug('BAD !supply ' +
-                                      '[Chat: ' + str(chat_id) + ']')
-
-                    bot.send_markdown_message(chat_id, output)
-
-                # ======================= INFORMATION ====================== #
-                elif arguments[0] == '!info':
-
-                    # Convert spaces in the name of the coin into hyphens
-                    coin = arguments[1].strip().replace(' ', '-')
-
-                    try:
-                        response = coinGecko.coin_info(coin)
-                    except:
-                        logging.warning('CoinGecko API failed [Coin info]')
-                        output = 'The service is unavailable, try again later'
-                        bot.send_message(chat_id, output)
-
-                        # Update the offset
-                        current_offset = update_id + 1
-                        continue
-
-                    if len(response) > 0:
-                        output = '*' + response['name'] + \
-                            ' (' + response['symbol'] + ')*\n\n'
-
-                        links = response['links']
-                        twitter_url = links['twitter_screen_name']
-                        if len(twitter_url) > 0:
-                            twitter_url = 'https://twitter.com/' + twitter_url
-
-                        facebook_url = links['facebook_username']
-                        if len(facebook_url) > 0:
-                            facebook_url = 'https://www.facebook.com/' + \
-                                facebook_url
-
-                        telegram_channel = links['telegram_channel_identifier']
-                        if len(telegram_channel) > 0:
-                            telegram_channel = '@' + telegram_channel
-
-                        output = output + \
-                            'Webpage: ' + links['homepage'][0] + '\n' + \
-                            'Twitter: ' + twitter_url + '\n' + \
-                            'Facebook: ' + facebook_url + '\n' + \
-                            'Telegram: ' + telegram_channel + '\n' + \
-                            'Subreddit: ' + links['subreddit_url'] + '\n\n'
-
-                        if response['genesis_date'] is not None:
-                            inverted_date = response['genesis_date']
-                            correct_date = datetime.datetime \
-                                .strptime(inverted_date, '%Y-%m-%d') \
-                                .strftime('%d/%m/%Y')
-                            output = output + \
-                                '- Genesis date: ' + correct_date + '\n'
-
-                        output = output + \
-                            '- CoinGecko rank: ' + \
-                            str(response['coingecko_rank']) + '\n'
-
-                        output = output + \
-                            '- Block time: ' + \
-                            str(response['block_time_in_minutes']) + \
-                            ' minutes\n'
-
-                        logging.debug('OK !info ' +
-                                      '[Chat: ' + str(chat_id) + ']')
-                    else:
-                        output = '*' + arguments[1] + '* not found'
-                        logging.debug('BAD !info ' +
-                                      '[Chat: ' + str(chat_id) + ']')
-
-                    bot.send_markdown_message(chat_id, output)
-
-                else:
-                    logging.debug('Unknown command ' +
-                                  '[Chat: ' + str(chat_id) + ']')
-                    output = 'Invalid format'
-                    bot.send_message(chat_id, output)
-
-            else:
-                logging.debug('Incomplete command ' +
-                              '[Chat: ' + str(chat_id) + ']')
-                output = 'Invalid format'
-                bot.send_message(chat_id, output)
-
-            # Update the offset
-            current_offset = update_id + 1
-
-
-def formatNumber(number):
-
-    # Add thousands separator
-    commaSeparator = "{:,}".format(number)
-
-    # Replace commas with dots and vice versa
-    num = commaSeparator.replace('.', '|').replace(',', '.').replace('|', ',')
-
-    # Check it has at least 2 decimal places
-    divide = num.split(',')
-    if len(divide) == 1:
-        num = num + ',00'  # No decimals, add 2
-    if len(divide) == 2 and len(divide[1]) == 1:
-        num = num + '0'  # Only 1 decimal, add 1
-
-    return num
+    try:
+        if webhook_url is not None:
+            with startup.phase('webhook'):
+                # Telegram posts to the path of the URL, unless a proxy
+                # in between changes it
+                server = webhook.WebhookServer(
+                    updates.submit,
+                    config.webhook_secret,
+                    port=getattr(config, 'webhook_port', 8443),
+                    path=getattr(config, 'webhook_path', None) or
+                    urllib.parse.urlsplit(webhook_url).path or '/',
+                    certfile=getattr(config, 'webhook_certificate', None),
+                    keyfile=getattr(config, 'webhook_key', None)
+                )
+                metrics.registry.gauge('bot_webhook',
+                                       'Updates posted by Telegram',
+                                       server.stats)
+                if not bot.set_webhook(webhook_url, config.webhook_secret,
+                                       allowed_updates=['message']):
+                    # Nothing would ever be posted to the server
+                    logging.error('Telegram refused the webhook')
+                    sys.exit(1)
+            logging.info('Webhook set')
+            startup.report()
+            server.serve_forever()
+            return
+
+        bot.delete_webhook()
+        updatePoller.start()
+        startup.report()
+        updatePoller.join()
+    finally:
+        saver.save()
 
 
 if __name__ == '__main__':
+    # A stop from the system saves the snapshot too
+    signal.signal(signal.SIGTERM, lambda number, frame: sys.exit(0))
     try:
         main()
     except KeyboardInterrupt:
@@ -0,0 +1,330 @@
+import bisect
+import contextlib
+import http.server
+import logging
+import threading
+import time
+
+# Upper bounds (seconds) of the latency histograms
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30)
+
+
+class Counter:
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels  # Label names
+        self.lock = threading.Lock()
+        self.values = {}  # Label values -> count
+
+    def inc(self, *labels, value=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+    def render(self):
+        lines = ['# HELP ' + self.name + ' ' + self.help,
+                 '# TYPE ' + self.name + ' counter']
+        for labels, value in sorted(self.snapshot().items()):
+            lines.append(self.name + _labels(self.labels, labels) + ' ' +
+                         _number(value))
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name, help, labels, buckets=latency_buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.values = {}  # Label values -> [bucket counts..., count, sum]
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 3)
+                self.values[labels] = counts
+            counts[index] += 1  # The last bucket is +Inf
+            counts[-2] += 1
+            counts[-1] += value
+
+    def snapshot(self):
+        with self.lock:
+            return {labels: list(counts)
+                    for labels, counts in self.values.items()}
+
+    def render(self):
+        lines = ['# HELP ' + self.name + ' ' + self.help,
+                 '# TYPE ' + self.name + ' histogram']
+        for labels, counts in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(self.name + '_bucket' +
+                             _labels(self.labels + ('le',),
+                                     labels + (str(bound),)) +
+                             ' ' + str(cumulative))
+            lines.append(self.name + '_count' +
+                         _labels(self.labels, labels) + ' ' +
+                         str(counts[-2]))
+            lines.append(self.name + '_sum' +
+                         _labels(self.labels, labels) + ' ' +
+                         _number(counts[-1]))
+        return lines
+
+
+class Gauge:
+
+    def __init__(self, name, help, function):
+        # function returns the current value, or a dictionary of names ->
+        # values (like the stats of the caches), exported as a name label
+        self.name = name
+        self.help = help
+        self.function = function
+
+    def render(self):
+        lines = ['# HELP ' + self.name + ' ' + self.help,
+                 '# TYPE ' + self.name + ' gauge']
+        try:
+            value = self.function()
+        except Exception:
+            return []
+        if isinstance(value, dict):
+            for key, number in sorted(value.items()):
+                lines.append(self.name + _labels(('name',), (key,)) + ' ' +
+                             _number(number))
+        else:
+            lines.append(self.name + ' ' + _number(value))
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, tuple(labels)))
+
+    def histogram(self, name, help, labels=(), buckets=latency_buckets):
+        return self._add(Histogram(name, help, tuple(labels), buckets))
+
+    def gauge(self, name, help, function):
+        return self._add(Gauge(name, help, function))
+
+    def _add(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        # Prometheus text format
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics of this process
+registry = Registry()
+
+commands = registry.counter(
+    'bot_commands_total', 'Commands handled by outcome',
+    ('command', 'outcome')
+)
+command_seconds = registry.histogram(
+    'bot_command_seconds', 'Time to handle a command, until it is replied',
+    ('command',)
+)
+upstream_seconds = registry.histogram(
+    'bot_upstream_seconds', 'Time of every request to an upstream API',
+    ('service', 'endpoint', 'status')
+)
+
+
+class MetricsServer:
+
+    def __init__(self, host='127.0.0.1', port=9100, metrics=registry):
+        # GET /metrics answers the metrics in the Prometheus text format
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                data = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True,
+                         name='metrics').start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class Reporter(threading.Thread):
+
+    def __init__(self, interval=60, metrics=registry):
+        # Every interval seconds, logs what happened since the last time and
+        # the current value of the gauges
+        super().__init__(name='metrics-reporter', daemon=True)
+        self.interval = interval
+        self.metrics = metrics
+        self.commands = commands.snapshot()
+        self.command_seconds = command_seconds.snapshot()
+        self.upstream_seconds = upstream_seconds.snapshot()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                for line in self.summary():
+                    logging.info(line)
+            except Exception:
+                logging.exception('Metrics summary failed')
+
+    def stop(self):
+        self.stopped.set()
+
+    def summary(self):
+        lines = []
+        now = commands.snapshot()
+        outcomes = {}  # Command -> outcome -> count
+        for (command, outcome), count in now.items():
+            count -= self.commands.get((command, outcome), 0)
+            if count > 0:
+                outcomes.setdefault(command, {})[outcome] = count
+        self.commands = now
+
+        now = command_seconds.snapshot()
+        for (command,), counts in sorted(now.items()):
+            counts = _delta(counts, self.command_seconds.get((command,)))
+            if counts[-2] == 0:
+                continue
+            lines.append(
+                'Metrics [' + command + '] ' +
+                ' '.join(outcome + '=' + str(count) for outcome, count
+                         in sorted(outcomes.get(command, {}).items())) +
+                _latencies(command_seconds.buckets, counts)
+            )
+        self.command_seconds = now
+
+        # Upstream requests, all the statuses of an endpoint together
+        now = upstream_seconds.snapshot()
+        endpoints = {}
+        for (service, endpoint, status), counts in now.items():
+            counts = _delta(counts, self.upstream_seconds.get(
+                (service, endpoint, status)
+            ))
+            total = endpoints.setdefault((service, endpoint),
+                                         [0] * len(counts))
+            for index, count in enumerate(counts):
+                total[index] += count
+        for (service, endpoint), counts in sorted(endpoints.items()):
+            if counts[-2] > 0:
+                lines.append('Metrics [' + service + ' ' + endpoint + '] ' +
+                             'requests=' + str(counts[-2]) +
+                             _latencies(upstream_seconds.buckets, counts))
+        self.upstream_seconds = now
+
+        with self.metrics.lock:
+            gauges = [metric for metric in self.metrics.metrics
+                      if isinstance(metric, Gauge)]
+        for gauge in gauges:
+            try:
+                value = gauge.function()
+            except Exception:
+                continue
+            lines.append('Metrics [' + gauge.name + '] ' + str(value))
+        return lines
+
+
+class Startup:
+
+    def __init__(self, name='Bot'):
+        # Time of every phase of the startup. Imports run before, their CPU
+        # time is the time the process spent before the first phase
+        self.name = name
+        self.imports = time.process_time()
+        self.start = time.monotonic()
+        self.phases = []  # (name, seconds)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.monotonic() - start))
+
+    def report(self):
+        # Logs the phases and exports them as a gauge
+        total = time.monotonic() - self.start
+        logging.info(self.name + ' ready in ' + str(round(total * 1000)) +
+                     ' ms [imports ' + str(round(self.imports * 1000)) +
+                     ' ms CPU, ' +
+                     ', '.join(name + ' ' + str(round(seconds * 1000)) +
+                               ' ms' for name, seconds in self.phases) + ']')
+        phases = dict(self.phases, imports=self.imports, total=total)
+        registry.gauge('bot_startup_seconds', 'Time of every startup phase',
+                       lambda: phases)
+
+
+def _delta(counts, previous):
+    if previous is None:
+        return counts
+    return [now - before for now, before in zip(counts, previous)]
+
+
+def _latencies(buckets, counts):
+    # Approximate percentiles: upper bound of the bucket where they fall
+    total = counts[-2]
+    text = ''
+    for name, fraction in (('p50', 0.5), ('p95', 0.95)):
+        cumulative = 0
+        for bound, count in zip(buckets + (None,), counts):
+            cumulative += count
+            if cumulative >= total * fraction:
+                text += ' ' + name + ('<=' + str(round(bound * 1000)) + 'ms'
+                                      if bound is not None else '>' +
+                                      str(buckets[-1]) + 's')
+                break
+    return text + ' avg=' + str(round(counts[-1] / total * 1000)) + 'ms'
+
+
+def _labels(names, values):
+    if len(names) == 0:
+        return ''
+    return '{' + ','.join(name + '="' + str(value).replace('"', '\\"') + '"'
+                          for name, value in zip(names, values)) + '}'
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return str(int(value))
+    return repr(float(value)) if isinstance(value, float) else str(value)
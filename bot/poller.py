@@ -0,0 +1,122 @@
+import json
+import logging
+import os
+import threading
+
+
+class UpdateJournal:
+
+    def __init__(self, path='updates.journal'):
+        # Updates received but maybe not handled yet, one JSON per line. They
+        # are written to disk before Telegram is told they were received, so
+        # a restart doesn't lose them
+        self.path = path
+        self.updates = []
+        if os.path.exists(path):
+            with open(path) as journal:
+                for line in journal:
+                    try:
+                        self.updates.append(json.loads(line))
+                    except ValueError:
+                        break  # Cut while it was written
+        self.file = open(path, 'a')
+
+    def append(self, updates):
+        if len(updates) == 0:
+            return
+        for update in updates:
+            self.file.write(json.dumps(update) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.updates.extend(updates)
+
+    def compact(self, offset):
+        # Forget the updates below offset, which were already handled
+        if offset is None:
+            return
+        kept = [update for update in self.updates
+                if update['update_id'] >= offset]
+        if len(kept) == len(self.updates):
+            return
+
+        with open(self.path + '.tmp', 'w') as journal:
+            for update in kept:
+                journal.write(json.dumps(update) + '\n')
+        self.file.close()
+        os.replace(self.path + '.tmp', self.path)
+        self.file = open(self.path, 'a')
+        self.updates = kept
+
+    def close(self):
+        self.file.close()
+
+
+class Poller(threading.Thread):
+
+    def __init__(self, bot, updates, journal=None, limit=100, timeout=30,
+                 allowed_updates=('message',)):
+        # Polls Telegram while the dispatcher handles the previous updates.
+        # The poller only waits for the handlers when the dispatcher is full
+        super().__init__(name='poller', daemon=True)
+        self.bot = bot
+        self.updates = updates  # Dispatcher
+        self.journal = journal
+        self.limit = limit
+        self.timeout = timeout
+        self.allowed_updates = list(allowed_updates)
+        self.offset = None  # Next update to ask for
+        self.polls = 0
+        self.received = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        logging.info('Poller starts')
+
+        # Updates received before a restart go first
+        if self.journal is not None and len(self.journal.updates) > 0:
+            logging.info(str(len(self.journal.updates)) +
+                         ' updates recovered from the journal')
+            self._submit(self.journal.updates)
+
+        failures = 0
+        while not self.stopped.is_set():
+            try:
+                received = self.bot.get_updates(
+                    self.offset, self.timeout, self.limit,
+                    self.allowed_updates
+                )
+                failures = 0
+            except Exception:
+                failures += 1
+                logging.warning('Telegram API failed to get updates')
+                self.stopped.wait(min(2 ** failures, 60))
+                continue
+
+            # Once stored, the next poll confirms them to Telegram
+            if self.journal is not None:
+                self.journal.append(received)
+            self.polls += 1
+            self.received += len(received)
+            self._submit(received)
+
+            if self.journal is not None:
+                self.journal.compact(self.updates.offset())
+
+    def _submit(self, received):
+        for update in received:
+            self.updates.submit(update)
+            self.offset = max(self.offset or 0, update['update_id'] + 1)
+
+    def resume(self, offset):
+        # Next update to ask for, saved by a previous run. Updates recovered
+        # from the journal go after it
+        if offset is not None and self.offset is None:
+            self.offset = offset
+
+    def stop(self):
+        self.stopped.set()
+
+    def stats(self):
+        return {'polls': self.polls,
+                'received': self.received,
+                'pending': self.updates.pending_count()}
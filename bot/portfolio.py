@@ -0,0 +1,67 @@
+import sqlite3
+import threading
+
+
+class PortfolioStore:
+
+    def __init__(self, path='portfolio.db', max_coins=50):
+        # Coins every chat watches and how much of each it holds (0 if it
+        # only watches it). Kept in SQLite and read from memory
+        self.max_coins = max_coins
+        self.lock = threading.Lock()
+        self.database = sqlite3.connect(path, check_same_thread=False)
+        self.database.execute(
+            'CREATE TABLE IF NOT EXISTS holdings ('
+            'chat_id INTEGER, coin TEXT, amount REAL, '
+            'PRIMARY KEY (chat_id, coin))'
+        )
+        self.database.commit()
+
+        self.chats = {}  # Chat -> {coin -> amount}
+        for chat_id, coin, amount in self.database.execute(
+                'SELECT chat_id, coin, amount FROM holdings'):
+            self.chats.setdefault(chat_id, {})[coin] = amount
+
+    def add(self, chat_id, coin, amount=None):
+        # Watch the coin. Without amount, a coin already watched keeps the
+        # amount it had. Returns False if the chat watches too many coins
+        with self.lock:
+            holdings = self.chats.get(chat_id, {})
+            if coin not in holdings and len(holdings) >= self.max_coins:
+                return False
+            if amount is None:
+                amount = holdings.get(coin, 0)
+            self.database.execute(
+                'INSERT OR REPLACE INTO holdings (chat_id, coin, amount) '
+                'VALUES (?, ?, ?)', (chat_id, coin, amount)
+            )
+            self.database.commit()
+            self.chats.setdefault(chat_id, {})[coin] = amount
+            return True
+
+    def remove(self, chat_id, coin):
+        # Returns False if the chat doesn't watch the coin
+        with self.lock:
+            holdings = self.chats.get(chat_id, {})
+            if coin not in holdings:
+                return False
+            self.database.execute(
+                'DELETE FROM holdings WHERE chat_id = ? AND coin = ?',
+                (chat_id, coin)
+            )
+            self.database.commit()
+            del holdings[coin]
+            if len(holdings) == 0:
+                del self.chats[chat_id]
+            return True
+
+    def holdings(self, chat_id):
+        # Coin -> amount, sorted by coin
+        with self.lock:
+            return dict(sorted(self.chats.get(chat_id, {}).items()))
+
+    def stats(self):
+        with self.lock:
+            return {'chats': len(self.chats),
+                    'coins': sum(len(holdings)
+                                 for holdings in self.chats.values())}
@@ -0,0 +1,75 @@
+import logging
+import threading
+import time
+
+
+class Prefetcher(threading.Thread):
+
+    def __init__(self, coinGecko, fixed=(), top=20, popular=10,
+                 interval=20, budget=10, ranking_interval=60 * 60):
+        super().__init__(name='prefetcher', daemon=True)
+        self.coinGecko = coinGecko
+        self.fixed = list(fixed)  # Coins always refreshed
+        self.top = top  # Coins taken from the market cap ranking
+        self.popular = popular  # Coins taken from the most queried ones
+        self.interval = interval  # Seconds between refreshes
+        self.budget = budget  # Upstream calls per minute for prefetching
+        self.ranking_interval = ranking_interval
+        self.ranking = []
+        self.ranking_time = None
+        self.next_coin = 0  # Next coin whose market data is refreshed
+        self.stopped = threading.Event()
+
+    def run(self):
+        logging.info('Prefetcher starts')
+        while not self.stopped.is_set():
+            try:
+                with self.coinGecko.background():
+                    self.refresh()
+            except Exception:
+                logging.warning('Prefetcher failed to refresh prices')
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+
+    def hot_set(self):
+        # Fixed coins, then the top of the ranking, then the popular ones
+        coins = []
+        for coin in self.fixed + self._ranking() + \
+                self.coinGecko.most_queried(self.popular):
+            if coin not in coins:
+                coins.append(coin)
+        return coins
+
+    def refresh(self):
+        coins = self.hot_set()
+        if len(coins) == 0:
+            return
+
+        # Calls allowed in every refresh, one of them for all the prices
+        calls = max(int(self.budget * self.interval / 60), 1)
+
+        # Entries must stay fresh until the next refresh updates them. Market
+        # data is refreshed a few coins at a time, so it lasts a whole round
+        rounds = -(-len(coins) // max(calls - 1, 1))
+        ttl = self.interval * 2
+        self.coinGecko.simple_prices(coins, refresh=True, ttl=ttl)
+
+        for _ in range(min(calls - 1, len(coins))):
+            coin = coins[self.next_coin % len(coins)]
+            self.next_coin += 1
+            self.coinGecko.market_data(coin, refresh=True,
+                                       ttl=self.interval * (rounds + 1))
+
+    def _ranking(self):
+        # Top coins by market cap, asked again every ranking_interval (and
+        # on the next round if it failed)
+        now = time.monotonic()
+        if self.top > 0 and (self.ranking_time is None or
+                             now - self.ranking_time > self.ranking_interval):
+            markets = self.coinGecko.coins_markets('usd', self.top,
+                                                   order='market_cap_desc')
+            self.ranking = [market.id for market in markets]
+            self.ranking_time = now
+        return self.ranking
@@ -0,0 +1,86 @@
+import os
+import re
+import threading
+import series
+import numpy as np
+
+# Every point is stored as 16 bytes: milliseconds since epoch and price
+point_type = np.dtype([('timestamp', '<i8'), ('price', '<f8')])
+
+# Only names made of these characters can become file names
+valid_name = re.compile(r'^[a-z0-9-]+$')
+
+
+class PriceStore:
+
+    def __init__(self, directory='prices'):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.series_locks = {}  # Series -> lock held while it's updated
+
+    def series_lock(self, coin, currency, step):
+        key = (coin, currency, step)
+        with self.lock:
+            if key not in self.series_locks:
+                self.series_locks[key] = threading.Lock()
+            return self.series_locks[key]
+
+    def valid(self, coin, currency):
+        return valid_name.match(coin) is not None and \
+            valid_name.match(currency) is not None
+
+    def read(self, coin, currency, step, start=None):
+        # (timestamps, prices) arrays of the points stored since start. The
+        # file is memory-mapped, so only the points asked for are loaded
+        path = self._path(coin, currency, step)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return series.empty()
+
+        points = np.memmap(path, dtype=point_type, mode='r')
+        if start is not None:
+            points = points[np.searchsorted(points['timestamp'], start):]
+        return np.array(points['timestamp']), np.array(points['price'])
+
+    def bounds(self, coin, currency, step):
+        # Timestamps of the first and the last point stored (None if empty)
+        path = self._path(coin, currency, step)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return None, None
+        points = np.memmap(path, dtype=point_type, mode='r')
+        return int(points['timestamp'][0]), int(points['timestamp'][-1])
+
+    def append(self, coin, currency, step, timestamps, prices):
+        # Add the points newer than the ones stored, keeping about step
+        # milliseconds between them (the resolution of this series)
+        last = self.bounds(coin, currency, step)[1]
+        points = _thin(timestamps, prices, step, last)
+        with open(self._path(coin, currency, step), 'ab') as store:
+            points.tofile(store)
+
+    def replace(self, coin, currency, step, timestamps, prices):
+        points = _thin(timestamps, prices, step, None)
+        path = self._path(coin, currency, step)
+        with open(path + '.tmp', 'wb') as store:
+            points.tofile(store)
+        os.replace(path + '.tmp', path)
+
+    def _path(self, coin, currency, step):
+        name = coin + '_' + currency + '_' + str(step) + '.bin'
+        return os.path.join(self.directory, name)
+
+
+def _thin(timestamps, prices, step, last):
+    # Points separated by about step milliseconds, starting after last.
+    # Upstream points are never exactly step apart, so allow some margin
+    gap = step * 9 // 10
+    keep = []
+    for index, timestamp in enumerate(timestamps):
+        if last is None or timestamp >= last + gap:
+            keep.append(index)
+            last = timestamp
+
+    points = np.empty(len(keep), dtype=point_type)
+    points['timestamp'] = timestamps[keep]
+    points['price'] = prices[keep]
+    return points
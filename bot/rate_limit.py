@@ -0,0 +1,119 @@
+import random
+import threading
+import time
+
+# Priority classes, lower numbers go first
+INTERACTIVE = 0  # Commands sent by users
+BACKGROUND = 1  # Prefetching and other jobs nobody is waiting for
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity):
+        self.rate = rate  # Tokens added per second
+        self.capacity = capacity  # Maximum burst
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, now=None):
+        # Seconds to wait until a token is available (0 if one was taken).
+        # Not thread safe, the caller must hold its own lock
+        wait = self.wait(now)
+        if wait == 0:
+            self.tokens -= 1
+        return wait
+
+    def wait(self, now=None):
+        # Seconds until a token is available, without taking it
+        if now is None:
+            now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class Scheduler:
+
+    def __init__(self, rate_per_minute=30, burst=5):
+        self.bucket = TokenBucket(rate_per_minute / 60, burst)
+        self.condition = threading.Condition()
+        self.waiting = [0, 0]  # Callers waiting for each priority
+        self.blocked_until = 0  # Upstream asked us to wait until then
+        self.granted = 0
+        self.throttled = 0  # Callers that had to wait for a token
+        self.timeouts = 0
+        self.limited = 0  # Rate limit answers received
+
+    def acquire(self, priority=INTERACTIVE, timeout=None):
+        # Wait for permission to send one request. Callers with a higher
+        # priority waiting always go first. Returns False on timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            # Don't wait at all if upstream blocks us for longer than that
+            if deadline is not None and self.blocked_until > deadline:
+                self.timeouts += 1
+                return False
+
+            self.waiting[priority] += 1
+            waited = False
+            try:
+                while True:
+                    now = time.monotonic()
+                    first = not any(self.waiting[:priority])
+                    if first and now >= self.blocked_until:
+                        wait = self.bucket.take(now)
+                        if wait == 0:
+                            self.granted += 1
+                            if waited:
+                                self.throttled += 1
+                            return True
+                    elif first:
+                        wait = self.blocked_until - now
+                    else:
+                        wait = 1  # Woken up when the others are done
+
+                    if deadline is not None:
+                        if now >= deadline:
+                            self.timeouts += 1
+                            return False
+                        wait = min(wait, deadline - now)
+                    waited = True
+                    self.condition.wait(wait)
+            finally:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
+
+    def block(self, seconds):
+        # Upstream answered "too many requests": nobody sends anything else
+        # until the time it asked for has passed
+        with self.condition:
+            self.limited += 1
+            self.blocked_until = max(self.blocked_until,
+                                     time.monotonic() + seconds)
+            self.bucket.tokens = 0
+
+    def stats(self):
+        with self.condition:
+            return {'granted': self.granted,
+                    'throttled': self.throttled,
+                    'timeouts': self.timeouts,
+                    'rate_limited': self.limited,
+                    'waiting_interactive': self.waiting[INTERACTIVE],
+                    'waiting_background': self.waiting[BACKGROUND]}
+
+
+def backoff(attempt, base=0.5, maximum=30):
+    # Exponential backoff with full jitter: a random wait up to
+    # base * 2^attempt, so callers that failed together don't retry together
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+def retry_after(headers, default):
+    # Seconds asked by a Retry-After header (only the seconds format)
+    try:
+        return max(float(headers.get('Retry-After')), 0)
+    except (TypeError, ValueError):
+        return default
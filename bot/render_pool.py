@@ -0,0 +1,77 @@
+import multiprocessing
+import threading
+
+
+class RenderPool:
+
+    class Busy(Exception):
+        pass
+
+    def __init__(self, processes=None, max_jobs=16, timeout=30,
+                 jobs_per_worker=50, initializer=None):
+        # Workers are started from scratch ("spawn") instead of forking this
+        # process, which runs many threads. Each worker is replaced by a new
+        # one after jobs_per_worker jobs, returning the memory it collected.
+        # Every worker runs initializer first (like loading the chart stack).
+        # Rendering in the calling threads, it runs in a thread of its own
+        if processes == 0:
+            self.pool = None  # Render in the calling thread
+            if initializer is not None:
+                threading.Thread(target=initializer, daemon=True,
+                                 name='render-init').start()
+        else:
+            context = multiprocessing.get_context('spawn')
+            self.pool = context.Pool(processes, initializer,
+                                     maxtasksperchild=jobs_per_worker)
+
+        # Jobs waiting or running. A slot is only freed when the job actually
+        # finishes, even if the caller stopped waiting for it
+        self.slots = threading.BoundedSemaphore(max_jobs)
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.jobs = 0
+        self.failed = 0
+
+    def render(self, function, *args):
+        # Run function(*args) in a worker and return its result (the PNG
+        # bytes). Raises RenderPool.Busy if the queue is full and
+        # multiprocessing.TimeoutError if the job takes too long
+        if self.pool is None:
+            return function(*args)
+
+        if not self.slots.acquire(timeout=self.timeout):
+            self._count(failed=True)
+            raise RenderPool.Busy('Too many charts waiting to be rendered')
+
+        try:
+            job = self.pool.apply_async(
+                function, args,
+                callback=lambda result: self.slots.release(),
+                error_callback=lambda error: self.slots.release()
+            )
+        except Exception:
+            self.slots.release()
+            raise
+
+        try:
+            result = job.get(self.timeout)
+        except Exception:
+            self._count(failed=True)
+            raise
+        self._count(failed=False)
+        return result
+
+    def stats(self):
+        with self.lock:
+            return {'jobs': self.jobs, 'failed': self.failed}
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+
+    def _count(self, failed):
+        with self.lock:
+            self.jobs += 1
+            if failed:
+                self.failed += 1
@@ -0,0 +1,100 @@
+import logging
+import threading
+import time
+import commands
+import metrics
+
+
+class Router:
+
+    def __init__(self, context, registry=commands.registry):
+        self.context = context
+        self.commands = {}  # Name -> command
+        self.limits = {}  # Name -> semaphore of the commands limited
+        for command in registry:
+            self.commands[command.name] = command
+            if command.max_concurrent is not None:
+                self.limits[command.name] = \
+                    threading.BoundedSemaphore(command.max_concurrent)
+
+    def handle(self, update):
+        # If the user edits a previous message, ignore it
+        if 'message' not in update:
+            chat_id = update['edited_message']['chat']['id']
+            logging.debug('Ignored edited message', extra={'chat': chat_id})
+            return
+
+        message = update['message']
+        chat_id = message['chat']['id']
+
+        # Check if it's a text message
+        if 'text' not in message:
+            logging.debug('Ignored non-text message',
+                          extra={'chat': chat_id})
+            return
+
+        # arguments[0] -> command
+        # arguments[1] -> actual arguments
+        arguments = message['text'].lower().strip().split(" ", 1)
+
+        command = self.commands.get(arguments[0])
+        if command is None or (command.needs_arguments and
+                               len(arguments) < 2):
+            if len(arguments) == 2:
+                logging.debug('Unknown command', extra={'chat': chat_id})
+            else:
+                logging.debug('Incomplete command', extra={'chat': chat_id})
+            commands.Text('Invalid format').send(self.context, chat_id)
+            return
+
+        argument = arguments[1] if len(arguments) == 2 else ''
+        limit = self.limits.get(command.name)
+        if limit is None:
+            self.run(command, chat_id, argument, message)
+        else:
+            with limit:
+                self.run(command, chat_id, argument, message)
+
+    def run(self, command, chat_id, argument, message):
+        start = time.monotonic()
+        outcome = self.reply(command, chat_id, argument, message)
+        elapsed = time.monotonic() - start
+        metrics.commands.inc(command.name, outcome)
+        metrics.command_seconds.observe(elapsed, command.name)
+        logging.debug('Command handled', extra={
+            'command': command.name, 'chat': chat_id, 'outcome': outcome,
+            'ms': round(elapsed * 1000)
+        })
+
+    def reply(self, command, chat_id, argument, message):
+        # Returns the outcome: ok, bad (the user asked for something wrong),
+        # upstream_failure, unavailable or error (the command failed)
+        try:
+            params = command.parse(argument, message)
+            command.resolve(self.context, params)
+            try:
+                data = command.fetch(self.context, params)
+            except Exception:
+                logging.warning('CoinGecko API failed ' +
+                                '[' + command.upstream + ']',
+                                extra={'command': command.name,
+                                       'chat': chat_id})
+                commands.Text(commands.unavailable).send(self.context,
+                                                         chat_id)
+                return 'upstream_failure'
+            reply = command.format(self.context, params, data)
+        except commands.InvalidFormat as error:
+            reply = error.reply
+        except commands.Unavailable as error:
+            logging.warning(str(error), extra={'command': command.name,
+                                               'chat': chat_id})
+            commands.Text(commands.unavailable).send(self.context, chat_id)
+            return 'unavailable'
+        except Exception:
+            logging.exception('Command failed', extra={'command': command.name,
+                                                       'chat': chat_id})
+            commands.Text(commands.unavailable).send(self.context, chat_id)
+            return 'error'
+
+        reply.send(self.context, chat_id)
+        return 'ok' if reply.ok else 'bad'
@@ -0,0 +1,251 @@
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+import requests
+import rate_limit
+
+
+class SendQueue:
+
+    class Chat:
+
+        def __init__(self, rate, burst):
+            self.jobs = collections.deque()  # Messages waiting, in order
+            self.bucket = rate_limit.TokenBucket(rate, burst)
+            self.blocked_until = 0  # Telegram asked to wait until then
+            self.busy = False  # A worker is sending one of its messages
+
+    class Job:
+
+        def __init__(self, method, args, callback):
+            self.method = method  # Method of the TelegramRequester
+            self.args = args
+            self.callback = callback  # Called with the response when sent
+            self.queued = time.monotonic()
+            self.attempts = 0
+
+    def __init__(self, bot, workers=4, global_rate=30, global_burst=5,
+                 chat_rate=1, chat_burst=3, max_pending=1000, max_per_chat=50,
+                 max_attempts=3, enqueue_timeout=5):
+        # Telegram allows about 30 messages per second in total and about one
+        # per second in each chat (short bursts are tolerated)
+        self.bot = bot
+        self.bucket = rate_limit.TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_per_chat = max_per_chat
+        self.max_attempts = max_attempts
+        self.enqueue_timeout = enqueue_timeout
+
+        # Blocks the callers when too many messages are waiting
+        self.slots = threading.BoundedSemaphore(max_pending)
+
+        self.condition = threading.Condition()
+        self.chats = {}  # Chat -> SendQueue.Chat
+        self.ready = []  # Heap of (time, order, chat) with messages to send
+        self.order = itertools.count()
+        self.pruned = time.monotonic()
+        self.closed = False
+
+        self.pending = 0
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.limited = 0
+        self.latencies = collections.deque(maxlen=1000)  # Seconds, recent
+
+        self.workers = []
+        for number in range(workers):
+            worker = threading.Thread(target=self._run, daemon=True,
+                                      name='sender-' + str(number))
+            worker.start()
+            self.workers.append(worker)
+
+    # The same methods as TelegramRequester, but they only queue the message.
+    # Return False if it had to be dropped
+    def send_message(self, chat_id, text, callback=None):
+        return self._enqueue(chat_id, 'send_message', (chat_id, text),
+                             callback)
+
+    def send_markdown_message(self, chat_id, text, callback=None):
+        return self._enqueue(chat_id, 'send_markdown_message', (chat_id, text),
+                             callback)
+
+    def send_photo(self, chat_id, photo, callback=None, first=False):
+        # With first, the photo goes before the rest of messages of the chat.
+        # Callbacks use it to send something instead of the message they got
+        return self._enqueue(chat_id, 'send_photo', (chat_id, photo),
+                             callback, first)
+
+    def _enqueue(self, chat_id, method, args, callback, first=False):
+        if not self.slots.acquire(timeout=self.enqueue_timeout):
+            return self._drop(chat_id, 'Send queue full')
+
+        with self.condition:
+            chat = self.chats.get(chat_id)
+            if chat is None:
+                chat = SendQueue.Chat(self.chat_rate, self.chat_burst)
+                self.chats[chat_id] = chat
+            if len(chat.jobs) >= self.max_per_chat:
+                self.slots.release()
+                return self._drop(chat_id, 'Too many messages for the chat')
+
+            # A chat is in the heap when it has messages and isn't busy
+            waiting = len(chat.jobs) > 0 or chat.busy
+            job = SendQueue.Job(method, args, callback)
+            if first:
+                chat.jobs.appendleft(job)
+            else:
+                chat.jobs.append(job)
+            self.pending += 1
+            if not waiting:
+                self._schedule(chat_id, time.monotonic())
+        return True
+
+    def _drop(self, chat_id, reason):
+        logging.warning(reason + ', message dropped',
+                        extra={'chat': chat_id})
+        with self.condition:
+            self.dropped += 1
+        return False
+
+    def _schedule(self, chat_id, when):
+        heapq.heappush(self.ready, (when, next(self.order), chat_id))
+        self.condition.notify()
+
+    def _run(self):
+        # Workers send messages of different chats in parallel, but every
+        # chat is only handled by a worker at a time to keep its order
+        while True:
+            with self.condition:
+                chat_id, chat, job = self._next_job()
+                if job is None:
+                    return
+
+            retry = self._send(chat_id, chat, job)
+
+            with self.condition:
+                chat.busy = False
+                if retry:
+                    chat.jobs.appendleft(job)
+                else:
+                    self.pending -= 1
+                    self.slots.release()
+                if len(chat.jobs) > 0:
+                    self._schedule(chat_id, time.monotonic())
+
+    def _next_job(self):
+        # Wait for a chat allowed to send now. The caller holds the lock
+        while not self.closed:
+            now = time.monotonic()
+            self._prune(now)
+            if len(self.ready) == 0:
+                self.condition.wait()
+                continue
+            if self.ready[0][0] > now:
+                self.condition.wait(self.ready[0][0] - now)
+                continue
+
+            chat_id = heapq.heappop(self.ready)[2]
+            chat = self.chats[chat_id]
+            wait = max(chat.bucket.wait(now), self.bucket.wait(now),
+                       chat.blocked_until - now)
+            if wait > 0:
+                self._schedule(chat_id, now + wait)
+                continue
+
+            chat.bucket.take(now)
+            self.bucket.take(now)
+            chat.busy = True
+            return chat_id, chat, chat.jobs.popleft()
+        return None, None, None
+
+    def _send(self, chat_id, chat, job):
+        # Returns True if the message must be sent again
+        job.attempts += 1
+        try:
+            response = getattr(self.bot, job.method)(*job.args)
+        except requests.RequestException:
+            logging.warning('Telegram API failed to send a message',
+                            extra={'chat': chat_id})
+            with self.condition:
+                self.failed += 1
+            return False
+
+        if response.status_code == 429 and job.attempts < self.max_attempts:
+            # Flood limit: nothing else is sent to the chat for a while
+            retry_after = _retry_after(response)
+            logging.warning('Telegram flood limit, waiting ' +
+                            str(retry_after) + ' s', extra={'chat': chat_id})
+            with self.condition:
+                self.limited += 1
+                chat.blocked_until = time.monotonic() + retry_after
+            return True
+
+        with self.condition:
+            if response.status_code == 200:
+                self.sent += 1
+                self.latencies.append(time.monotonic() - job.queued)
+            else:
+                self.failed += 1
+        if response.status_code != 200:
+            logging.warning('Telegram refused a message',
+                            extra={'chat': chat_id,
+                                   'status': response.status_code})
+
+        if job.callback is not None:
+            try:
+                job.callback(response)
+            except Exception:
+                logging.exception('Send callback failed',
+                                  extra={'chat': chat_id})
+        return False
+
+    def _prune(self, now):
+        # Forget the chats with nothing to send that could send right away
+        if now - self.pruned < 60:
+            return
+        self.pruned = now
+        for chat_id in list(self.chats):
+            chat = self.chats[chat_id]
+            if len(chat.jobs) == 0 and not chat.busy and \
+                    chat.blocked_until <= now and \
+                    chat.bucket.wait(now) == 0 and \
+                    chat.bucket.tokens >= chat.bucket.capacity:
+                del self.chats[chat_id]
+
+    def stats(self):
+        with self.condition:
+            latencies = sorted(self.latencies)
+            stats = {'depth': self.pending,
+                     'chats': len(self.chats),
+                     'sent': self.sent,
+                     'dropped': self.dropped,
+                     'failed': self.failed,
+                     'rate_limited': self.limited}
+        if len(latencies) > 0:
+            stats['latency_avg_ms'] = \
+                round(sum(latencies) / len(latencies) * 1000)
+            stats['latency_p95_ms'] = \
+                round(latencies[int(len(latencies) * 0.95)] * 1000)
+            stats['latency_max_ms'] = round(latencies[-1] * 1000)
+        return stats
+
+    def close(self):
+        # Stop the workers. Messages still waiting are discarded
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join()
+
+
+def _retry_after(response):
+    # Seconds Telegram asked to wait before sending anything else
+    try:
+        return response.json()['parameters']['retry_after']
+    except (ValueError, KeyError, TypeError):
+        return rate_limit.retry_after(response.headers, 1)
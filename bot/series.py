@@ -0,0 +1,45 @@
+import numpy as np
+
+# Price series are kept as two NumPy arrays: timestamps (milliseconds since
+# epoch, int64) and prices (float64)
+
+
+def from_points(points):
+    # Convert the [[milliseconds, price], ...] list returned by CoinGecko
+    if len(points) == 0:
+        return empty()
+    data = np.asarray(points, dtype=np.float64)
+    return data[:, 0].astype(np.int64), data[:, 1]
+
+
+def empty():
+    return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+
+def add_point(timestamps, prices, timestamp, price):
+    # New arrays with the point added at the end
+    return np.append(timestamps, np.int64(timestamp)), \
+        np.append(prices, np.float64(price))
+
+
+def resample(timestamps, prices, points):
+    # Reduce the series to the given number of points: the first one and the
+    # last point (closing price) of each of the points - 1 buckets of equal
+    # time the series is split into
+    if len(timestamps) <= points:
+        return timestamps, prices
+
+    edges = np.linspace(timestamps[0], timestamps[-1], points)
+    closes = np.searchsorted(timestamps, edges[1:], side='right') - 1
+    indexes = np.unique(np.concatenate(([0], closes)))
+    return timestamps[indexes], prices[indexes]
+
+
+def tendencies(prices):
+    # Arrow showing if each price went down, stayed or went up compared to
+    # the previous one. The first price has nothing to compare with
+    if len(prices) == 0:
+        return np.empty(0, dtype=object)
+    arrows = np.array(['⬇️', '➡️', '⬆️'], dtype=object)
+    changes = np.sign(np.diff(prices)).astype(np.int64) + 1
+    return np.concatenate((['⏹️'], arrows[changes]))
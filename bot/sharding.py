@@ -0,0 +1,344 @@
+import collections
+import heapq
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+import dispatcher
+
+
+def shard_of(update, shards):
+    # Updates of the same chat always go to the same worker
+    chat_id = dispatcher.update_chat(update)
+    if chat_id is None:
+        return update['update_id'] % shards
+    return chat_id % shards
+
+
+class SharedCache:
+
+    def __init__(self, entries, max_size=1024):
+        # Same interface as coingecko_api.TTLCache, but the entries live in a
+        # dictionary of a multiprocessing manager shared by every worker.
+        # Wall clock times are used, monotonic clocks are per process
+        self.entries = entries  # Key -> (expiration, value)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+
+    def get(self, key, stale=False):
+        entry = self.entries.get(key)
+        with self.lock:
+            if entry is None or (entry[0] <= time.time() and not stale):
+                if not stale:
+                    self.misses += 1
+                return False, None
+            if stale:
+                self.stale_hits += 1
+            else:
+                self.hits += 1
+            return True, entry[1]
+
+    def put(self, key, value, ttl):
+        self.entries[key] = (time.time() + ttl, value)
+        if len(self.entries) > self.max_size:
+            self._evict()
+
+    def _evict(self):
+        # Expired entries go first, then the ones expiring sooner
+        now = time.time()
+        entries = sorted(self.entries.items(), key=lambda item: item[1][0])
+        for key, (expiration, _) in entries:
+            if expiration > now and \
+                    len(self.entries) <= self.max_size * 9 // 10:
+                break
+            self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def dump(self):
+        return [(key, expiration, value)
+                for key, (expiration, value) in self.entries.items()]
+
+    def restore(self, entries, max_stale=60 * 60):
+        now = time.time()
+        for key, expiration, value in entries:
+            if expiration > now - max_stale:
+                self.put(key, value, expiration - now)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'stale_hits': self.stale_hits,
+                    'hit_ratio': self.hits / total if total > 0 else 0.0,
+                    'size': len(self.entries)}
+
+
+class SharedCounter:
+
+    def __init__(self, counts, lock):
+        # The part of collections.Counter that coingecko_api uses for the
+        # coins asked the most, with the counts in a dictionary of a
+        # multiprocessing manager, so every worker adds to the same ones.
+        # lock is a lock of the manager too
+        self.counts = counts
+        self.lock = lock
+
+    def update(self, counts):
+        if not isinstance(counts, dict):
+            counts = collections.Counter(counts)
+        with self.lock:
+            for key, count in counts.items():
+                self.counts[key] = self.counts.get(key, 0) + count
+
+    def most_common(self, limit):
+        return heapq.nlargest(limit, self.counts.items(),
+                              key=lambda item: item[1])
+
+    def items(self):
+        return self.counts.items()
+
+
+class ShardRouter:
+
+    def __init__(self, factory, shards=2, ordered=True, max_queued=256,
+                 max_workers=8, max_pending=64, max_crashes=3,
+                 max_backoff=30):
+        # Ingestion side: the same submit and offset as a Dispatcher, but the
+        # updates are handled by worker processes, one for every shard.
+        # factory(shard, shards, cache, popular) runs in each worker and
+        # returns the function handling its updates. An update that was running in
+        # max_crashes workers that died is dropped, and workers dying one
+        # after another are restarted waiting longer every time (up to
+        # max_backoff seconds)
+        self.factory = factory
+        self.shards = shards
+        self.ordered = ordered
+        self.max_queued = max_queued
+        self.max_workers = max_workers  # Threads of each worker
+        self.max_pending = max_pending
+        self.max_crashes = max_crashes
+        self.max_backoff = max_backoff
+
+        self.context = multiprocessing.get_context('spawn')
+        self.manager = self.context.Manager()
+        self.cache = self.manager.dict()  # Entries of every SharedCache
+        # Coins asked the most by the users of every worker
+        self.popular = SharedCounter(self.manager.dict(), self.manager.Lock())
+        # (update, finished) as workers start and finish the updates. Written
+        # right away, so it's there even if the worker dies just after
+        self.done = self.context.SimpleQueue()
+
+        self.lock = threading.Lock()
+        self.pending = {}  # Update -> (shard, update), in arrival order
+        self.last_update = None
+        self.queues = [None] * shards
+        self.workers = [None] * shards
+        self.started = [None] * shards  # When every worker started
+        self.failures = [0] * shards  # Workers that died one after another
+        self.restart_at = [None] * shards  # When dead workers are replaced
+        self.suspect = [None] * shards  # Update running alone in every worker
+        self.running = set()  # Updates started and not finished
+        self.crashes = {}  # Update -> workers that died while it was running
+        self.restarts = 0
+        self.dropped = 0
+        self.stopped = threading.Event()
+
+        for shard in range(shards):
+            self.queues[shard], self.workers[shard] = self._start(shard)
+        threading.Thread(target=self._collect, daemon=True,
+                         name='shard-collector').start()
+        threading.Thread(target=self._supervise, daemon=True,
+                         name='shard-supervisor').start()
+
+    def _start(self, shard):
+        # A new worker always gets a new queue: the old one may have been
+        # left broken by the worker that died
+        jobs = self.context.Queue(self.max_queued)
+        worker = self.context.Process(
+            target=_work, name='shard-' + str(shard), daemon=True,
+            args=(self.factory, shard, self.shards, self.cache, self.popular,
+                  jobs, self.done, self.max_workers, self.max_pending)
+        )
+        worker.start()
+        self.started[shard] = time.monotonic()
+        return jobs, worker
+
+    def submit(self, update):
+        # Returns False if the update had already been submitted
+        update_id = update['update_id']
+        shard = shard_of(update, self.shards)
+        with self.lock:
+            if self.ordered and self.last_update is not None and \
+                    update_id <= self.last_update:
+                return False
+            if self.last_update is None or update_id > self.last_update:
+                self.last_update = update_id
+            self.pending[update_id] = (shard, update)
+            jobs = self.queues[shard]
+
+        # Blocks while the worker is full. If it's replaced in the meantime,
+        # the new one already got this update
+        while not self.stopped.is_set():
+            try:
+                jobs.put(update, timeout=1)
+                break
+            except queue.Full:
+                with self.lock:
+                    if jobs is not self.queues[shard]:
+                        break
+        return True
+
+    def _collect(self):
+        while not self.stopped.is_set():
+            update_id, finished = self.done.get()
+            with self.lock:
+                if not finished:
+                    self.running.add(update_id)
+                    continue
+                self.running.discard(update_id)
+                self.pending.pop(update_id, None)
+                self.crashes.pop(update_id, None)
+
+    def _supervise(self):
+        # Workers that die are replaced, and the new ones get the updates they
+        # hadn't finished (so some of them might be handled twice)
+        while not self.stopped.wait(1):
+            for shard, worker in enumerate(self.workers):
+                if worker.is_alive():
+                    continue
+                if self.restart_at[shard] is None:
+                    self._failed(shard, worker)
+                if time.monotonic() < self.restart_at[shard]:
+                    continue
+                self.restart_at[shard] = None
+
+                self._restart(shard)
+
+    def _restart(self, shard):
+        jobs, worker = self._start(shard)
+        with self.lock:
+            self.workers[shard] = worker
+            self.restarts += 1
+            suspects = [(update_id, update) for update_id, (owner, update)
+                        in self.pending.items()
+                        if owner == shard and update_id in self.crashes]
+
+        # Updates that were running when a worker died go first and one at a
+        # time, so only the one killing the workers is blamed for it. The
+        # rest wait in the old queue
+        sent = set()
+        for update_id, update in suspects:
+            self.suspect[shard] = update_id
+            jobs.put(update)
+            sent.add(update_id)
+            deadline = time.monotonic() + 30
+            while worker.is_alive() and time.monotonic() < deadline and \
+                    not self.stopped.wait(0.05):
+                with self.lock:
+                    if update_id not in self.pending:
+                        break
+            if not worker.is_alive():
+                return
+            self.suspect[shard] = None
+
+        with self.lock:
+            self.queues[shard] = jobs
+            unfinished = [update for update_id, (owner, update)
+                          in self.pending.items()
+                          if owner == shard and update_id not in sent]
+        for update in unfinished:
+            jobs.put(update)
+
+    def _failed(self, shard, worker):
+        # A worker that lived for a minute doesn't count as failing again
+        if time.monotonic() - self.started[shard] > 60:
+            self.failures[shard] = 0
+        delay = min(2 ** self.failures[shard] - 1, self.max_backoff)
+        self.failures[shard] += 1
+        self.restart_at[shard] = time.monotonic() + delay
+        logging.warning('Shard ' + str(shard) + ' stopped ' +
+                        '[Exit code: ' + str(worker.exitcode) + '] ' +
+                        '[Restart in ' + str(delay) + ' s]')
+
+        # The update killing the workers is among the ones they were running
+        # (or it's the suspect running alone). After max_crashes, it's given
+        # up
+        suspect, self.suspect[shard] = self.suspect[shard], None
+        with self.lock:
+            for update_id, (owner, _) in list(self.pending.items()):
+                if owner != shard or (update_id != suspect if suspect
+                                      else update_id not in self.running):
+                    continue
+                self.running.discard(update_id)
+                crashes = self.crashes.get(update_id, 0) + 1
+                if crashes < self.max_crashes:
+                    self.crashes[update_id] = crashes
+                    continue
+                del self.pending[update_id]
+                self.crashes.pop(update_id, None)
+                self.dropped += 1
+                logging.error('Update ' + str(update_id) + ' dropped, ' +
+                              str(crashes) + ' workers died handling it')
+
+    def offset(self):
+        # First update that hasn't been handled yet
+        with self.lock:
+            if len(self.pending) > 0:
+                return min(self.pending)
+            if self.last_update is None:
+                return None
+            return self.last_update + 1
+
+    def pending_count(self):
+        with self.lock:
+            return len(self.pending)
+
+    def stats(self):
+        with self.lock:
+            return {'shards': self.shards,
+                    'pending': len(self.pending),
+                    'restarts': self.restarts,
+                    'dropped': self.dropped,
+                    'alive': sum(worker.is_alive()
+                                 for worker in self.workers)}
+
+    def shutdown(self, timeout=10):
+        self.stopped.set()
+        for jobs in self.queues:
+            jobs.put(None)
+        for worker in self.workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+        self.manager.shutdown()
+
+
+def _work(factory, shard, shards, cache, popular, jobs, done, max_workers,
+          max_pending):
+    # Main function of a worker process: its own dispatcher keeps the order
+    # of every chat, as all the updates of a chat come to this worker
+    handle = factory(shard, shards, cache, popular)
+
+    def handle_and_report(update):
+        done.put((update['update_id'], False))
+        try:
+            handle(update)
+        finally:
+            done.put((update['update_id'], True))
+
+    updates = dispatcher.Dispatcher(handle_and_report, max_workers,
+                                    max_pending, ordered=False)
+    while True:
+        update = jobs.get()
+        if update is None:
+            break
+        if not updates.submit(update):
+            done.put((update['update_id'], True))  # Repeated
+    updates.shutdown()
@@ -0,0 +1,72 @@
+import logging
+import os
+import pickle
+import threading
+import time
+
+
+class Snapshot(threading.Thread):
+
+    def __init__(self, path='snapshot.pickle', interval=5 * 60):
+        # State that lets a restarted bot answer at full speed right away,
+        # like the cached answers or the next update to ask Telegram for.
+        # Saved every interval seconds and when the bot stops
+        super().__init__(name='snapshot', daemon=True)
+        self.path = path
+        self.interval = interval
+        self.sources = {}  # Name -> (dump, restore) functions
+        self.lock = threading.Lock()
+        self.saved = None  # Wall clock time of the last snapshot
+        self.stopped = threading.Event()
+
+    def add(self, name, dump, restore):
+        # dump() returns something that can be pickled, which is given back
+        # to restore() by the next run
+        self.sources[name] = (dump, restore)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.save()
+            except Exception:
+                logging.exception('Snapshot failed')
+
+    def stop(self):
+        self.stopped.set()
+
+    def save(self):
+        state = {}
+        for name, (dump, _) in self.sources.items():
+            try:
+                state[name] = dump()
+            except Exception:
+                logging.exception('Snapshot failed to dump ' + name)
+
+        # Written aside and then renamed, a crash never leaves half of it
+        with self.lock:
+            with open(self.path + '.tmp', 'wb') as stored:
+                pickle.dump({'saved': time.time(), 'state': state}, stored,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(self.path + '.tmp', self.path)
+            self.saved = time.time()
+
+    def load(self):
+        # Restores every source found in the snapshot. Returns False if
+        # there's no snapshot
+        try:
+            with open(self.path, 'rb') as stored:
+                snapshot = pickle.load(stored)
+        except Exception:
+            return False
+
+        for name, (_, restore) in self.sources.items():
+            if name not in snapshot['state']:
+                continue
+            try:
+                restore(snapshot['state'][name])
+            except Exception:
+                logging.exception('Snapshot failed to restore ' + name)
+        logging.info('Snapshot of ' + str(round(time.time() -
+                                                snapshot['saved'])) +
+                     ' seconds ago restored')
+        return True
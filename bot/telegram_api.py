@@ -1,27 +1,96 @@
-import requests
+import json
+import time
+import http_session
+import metrics
 
 
 class TelegramRequester:
 
-    def __init__(self, token):
+    url_api = 'https://api.telegram.org/bot{}/'
+
+    def __init__(self, token, pool_size=10, connect_timeout=5,
+                 read_timeout=30, retries=3, url=url_api):
         self.token = token
-        self.url = "https://api.telegram.org/bot{}/".format(token)
+        self.url = url.format(token)
+        self.session = http_session.create_session(pool_size, retries)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    def get_updates(self, offset=None, timeout=30, limit=100,
+                    allowed_updates=None):
+        # Every update below offset is confirmed, Telegram won't send it again
+        params = {'offset': offset, 'timeout': timeout, 'limit': limit}
+        if allowed_updates is not None:
+            params['allowed_updates'] = json.dumps(allowed_updates)
 
-    def get_updates(self, offset=None, timeout=30):
-        params = {'offset': offset, 'timeout': timeout}
-        response = requests.get(self.url + 'getUpdates', params)
+        # Long polling keeps the request open for the whole timeout
+        response = self._request(
+            'get', 'getUpdates', params=params,
+            timeout=(self.connect_timeout, timeout + self.read_timeout)
+        )
         return response.json()['result']
 
+    def set_webhook(self, url, secret, max_connections=40,
+                    allowed_updates=None):
+        # Telegram posts the updates to url instead of waiting for getUpdates
+        params = {'url': url, 'secret_token': secret,
+                  'max_connections': max_connections}
+        if allowed_updates is not None:
+            params['allowed_updates'] = json.dumps(allowed_updates)
+        response = self._request('post', 'setWebhook', data=params)
+        return response.json()['ok']
+
+    def delete_webhook(self):
+        # getUpdates doesn't work while a webhook is set
+        response = self._request('post', 'deleteWebhook')
+        return response.json()['ok']
+
     def send_message(self, chat_id, text):
         params = {'chat_id': chat_id, 'text': text}
-        return requests.post(self.url + 'sendMessage', params)
+        return self._request('post', 'sendMessage', data=params)
 
     def send_markdown_message(self, chat_id, text):
         params = {'chat_id': chat_id, 'text': text, 'parse_mode': 'Markdown'}
-        return requests.post(self.url + 'sendMessage', params)
+        return self._request('post', 'sendMessage', data=params)
 
     def send_photo(self, chat_id, photo):
-        image = {'photo': photo}
+        # The photo can be the PNG bytes, an open file or the identifier of a
+        # photo already uploaded to Telegram
         params = {'chat_id': chat_id}
-        return requests.post(self.url + 'sendPhoto',
-                             params, files=image)
+        if isinstance(photo, str):
+            params['photo'] = photo
+            return self._request('post', 'sendPhoto', data=params)
+
+        image = {'photo': ('graph.png', photo, 'image/png')}
+        return self._request('post', 'sendPhoto', data=params, files=image)
+
+    def connection_stats(self):
+        return http_session.connection_stats(self.session)
+
+    def _timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+    def _request(self, http_method, method, **arguments):
+        # Every call to the API is timed, by method and status
+        arguments.setdefault('timeout', self._timeout())
+        start = time.monotonic()
+        status = 'error'
+        try:
+            response = self.session.request(http_method, self.url + method,
+                                            **arguments)
+            status = str(response.status_code)
+            return response
+        finally:
+            metrics.upstream_seconds.observe(time.monotonic() - start,
+                                             'telegram', method, status)
+
+
+def photo_file_id(response):
+    # Identifier of the photo sent, to send it again without uploading it
+    try:
+        response_json = response.json()
+        if response_json['ok']:
+            return response_json['result']['photo'][-1]['file_id']
+    except (ValueError, KeyError, IndexError):
+        pass
+    return None
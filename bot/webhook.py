@@ -0,0 +1,193 @@
+import hmac
+import http.server
+import json
+import logging
+import queue
+import ssl
+import threading
+import time
+import urllib.error
+import urllib.request
+
+
+class WebhookServer:
+
+    def __init__(self, submit, secret, host='0.0.0.0', port=8443, path='/',
+                 max_queue=256, certfile=None, keyfile=None):
+        # Telegram posts every update to path. Updates are queued and a
+        # single thread passes them to submit, so slow handlers only make
+        # the queue grow until it's full
+        self.submit = submit
+        self.secret = secret
+        self.path = path
+        self.queue = queue.Queue(max_queue)
+        self.lock = threading.Lock()
+        self.received = 0
+        self.rejected = 0  # Wrong secret, path or body
+        self.refused = 0  # Queue full, Telegram sends them again later
+
+        server = self  # Seen by the request handler
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                self.send_response(server.handle(self.path, self.headers,
+                                                 self.rfile))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass  # Every request would end up in the log
+
+        self.httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+        # Telegram only posts to HTTPS. Without a certificate, the server is
+        # expected to run behind a proxy that terminates TLS
+        if certfile is not None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            self.httpd.socket = context.wrap_socket(self.httpd.socket,
+                                                    server_side=True)
+
+        self.feeder = threading.Thread(target=self._feed, daemon=True,
+                                       name='webhook-feeder')
+
+    def handle(self, path, headers, body):
+        # HTTP status of the answer to a POST
+        token = headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if path != self.path or \
+                not hmac.compare_digest(token.encode(), self.secret.encode()):
+            logging.warning('Webhook post rejected, wrong ' +
+                            ('path ' + path if path != self.path
+                             else 'secret token'))
+            self._count(rejected=True)
+            return 403
+
+        try:
+            length = int(headers.get('Content-Length', 0))
+            if length <= 0 or length > 1024 * 1024:
+                raise ValueError('Wrong size')
+            update = json.loads(body.read(length))
+            if not isinstance(update, dict) or 'update_id' not in update:
+                raise ValueError('Not an update')
+        except ValueError:
+            self._count(rejected=True)
+            return 400
+
+        # Any answer but 2xx makes Telegram send the update again later
+        try:
+            self.queue.put(update, timeout=1)
+        except queue.Full:
+            self._count(refused=True)
+            return 503
+        self._count()
+        return 200
+
+    def _feed(self):
+        while True:
+            update = self.queue.get()
+            if update is None:
+                return
+            try:
+                self.submit(update)
+            except Exception:
+                logging.exception('Update failed',
+                                  extra={'update': update['update_id']})
+
+    def _count(self, rejected=False, refused=False):
+        with self.lock:
+            if rejected:
+                self.rejected += 1
+            elif refused:
+                self.refused += 1
+            else:
+                self.received += 1
+
+    def start(self):
+        # Serve in background threads
+        self.feeder.start()
+        threading.Thread(target=self.httpd.serve_forever, daemon=True,
+                         name='webhook').start()
+
+    def serve_forever(self):
+        self.feeder.start()
+        self.httpd.serve_forever()
+
+    def address(self):
+        return self.httpd.server_address
+
+    def stats(self):
+        with self.lock:
+            return {'received': self.received,
+                    'rejected': self.rejected,
+                    'refused': self.refused,
+                    'queued': self.queue.qsize()}
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.queue.put(None)
+
+
+def post_update(url, update, secret, timeout=5):
+    # Post an update like Telegram does. Returns the HTTP status
+    request = urllib.request.Request(
+        url, data=json.dumps(update).encode(), method='POST',
+        headers={'Content-Type': 'application/json',
+                 'X-Telegram-Bot-Api-Secret-Token': secret}
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+
+
+def synthetic_update(update_id, chat_id, text):
+    return {'update_id': update_id,
+            'message': {'message_id': update_id,
+                        'date': int(time.time()),
+                        'chat': {'id': chat_id, 'type': 'private'},
+                        'text': text}}
+
+
+if __name__ == '__main__':
+    # Local check with no network: post synthetic updates (some of them
+    # twice) from several threads and wait for the dispatcher to handle them
+    import concurrent.futures
+    import dispatcher
+
+    total = 200
+    handled = []
+    done = threading.Event()
+
+    def handle(update):
+        handled.append(update['update_id'])
+        if len(handled) == total:
+            done.set()
+
+    updates = dispatcher.Dispatcher(handle, ordered=False)
+    server = WebhookServer(updates.submit, 'secret', host='127.0.0.1', port=0)
+    server.start()
+    url = 'http://127.0.0.1:' + str(server.address()[1]) + '/'
+
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        statuses = list(executor.map(
+            lambda number: post_update(
+                url, synthetic_update(number, number % 10, '!price bitcoin'),
+                'secret'
+            ),
+            list(range(1, total + 1)) + list(range(1, total + 1, 10))
+        ))
+    done.wait(10)
+    elapsed = time.monotonic() - start
+    updates.shutdown()
+
+    print('Accepted:', statuses.count(200), 'of', len(statuses))
+    print('Wrong secret:', post_update(url, synthetic_update(0, 1, ''), 'x'))
+    print('Handled:', len(handled), 'different:', len(set(handled)),
+          'in', round(elapsed, 2), 's')
+    print(server.stats())
+    server.close()